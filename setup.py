@@ -28,6 +28,10 @@ setup(
         'setuptools',
         'Flask',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+        'async': ['gevent'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
@@ -36,5 +40,8 @@ setup(
     [paste.app_factory]
     main = presence_analyzer.script:make_app
     debug = presence_analyzer.script:make_debug
+
+    [paste.server_runner]
+    gevent = presence_analyzer.server:server_runner
     """,
 )
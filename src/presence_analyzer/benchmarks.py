@@ -0,0 +1,609 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmarks.
+
+Run with: bin/benchmark [--users N] [--days N] [--output FILE] [CSV_FILE]
+
+Results are written as JSON, so they can be compared between commits
+with: bin/benchmark --compare OLD_FILE [--output NEW_FILE]
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import urllib2
+from array import array
+from datetime import date, datetime, timedelta
+from threading import Thread
+
+from presence_analyzer import app, server, settings, vectorized
+from presence_analyzer.loader import parse_presence_rows
+from presence_analyzer.models import User
+from presence_analyzer.store import PresenceStore
+from presence_analyzer.utils import (
+    RESPONSES,
+    get_data,
+    group_by_weekday,
+    mean,
+    seconds_since_midnight,
+)
+
+
+SAMPLE_DATA_CSV = os.path.join(settings.APP_DATA, 'sample_data.csv')
+"""Default CSV file used by benchmarks"""
+
+
+def legacy_parse(path):
+    """
+    Parses CSV file with datetime.strptime, like get_data used to.
+    """
+    rows = []
+    with open(path, 'r') as csvfile:
+        for row in csv.reader(csvfile, delimiter=','):
+            if len(row) != 4:
+                continue
+            try:
+                rows.append((
+                    int(row[0]),
+                    datetime.strptime(row[1], '%Y-%m-%d').toordinal(),
+                    seconds_since_midnight(
+                        datetime.strptime(row[2], '%H:%M:%S').time()
+                    ),
+                    seconds_since_midnight(
+                        datetime.strptime(row[3], '%H:%M:%S').time()
+                    ),
+                ))
+            except (ValueError, TypeError):
+                pass
+    return rows
+
+
+def fast_parse(path):
+    """
+    Parses CSV file with parse_presence_rows.
+    """
+    with open(path, 'r') as csvfile:
+        return list(parse_presence_rows(csvfile))
+
+
+def best_of(function, repeat=5):
+    """
+    Returns the shortest of repeated function runs, in seconds.
+    """
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def bench_parsers(path=SAMPLE_DATA_CSV, repeat=5):
+    """
+    Compares legacy and fast CSV parsers on given file.
+
+    Legacy parser keeps rows fast one rejects by validation, like ones
+    ending before they start, their number is reported.
+    """
+    rejected = len(legacy_parse(path)) - len(fast_parse(path))
+    legacy = best_of(lambda: legacy_parse(path), repeat)
+    fast = best_of(lambda: fast_parse(path), repeat)
+    return {
+        'legacy_parse_s': legacy,
+        'fast_parse_s': fast,
+        'speedup': legacy / fast,
+        'rejected_rows': rejected,
+    }
+
+
+def synthetic_store(users, days, seed=0):
+    """
+    Builds store with random presence of given number of users and days.
+    """
+    generator = random.Random(seed)
+    first_day = date(2013, 1, 1).toordinal()
+    user_ids, day_ordinals, starts, ends = (array('i') for _ in xrange(4))
+    for user_id in xrange(users):
+        user_ids.extend(array('i', [user_id]) * days)
+        day_ordinals.extend(xrange(first_day, first_day + days))
+        for _ in xrange(days):
+            start = generator.randint(6 * 3600, 11 * 3600)
+            starts.append(start)
+            ends.append(start + generator.randint(3600, 10 * 3600))
+    return PresenceStore(user_ids, day_ordinals, starts, ends)
+
+
+def legacy_weekday_stats(store):
+    """
+    Computes weekday statistics with group_by_weekday, mean and interval.
+    """
+    result = {}
+    for user_id in store:
+        items = store[user_id]
+        intervals = group_by_weekday(items)
+        starts = [[], [], [], [], [], [], []]
+        ends = [[], [], [], [], [], [], []]
+        for day, item in items.iteritems():
+            starts[day.weekday()].append(seconds_since_midnight(item['start']))
+            ends[day.weekday()].append(seconds_since_midnight(item['end']))
+        result[user_id] = [
+            (
+                len(intervals[i]),
+                sum(intervals[i]),
+                mean(intervals[i]),
+                mean(starts[i]),
+                mean(ends[i]),
+            )
+            for i in xrange(7)
+        ]
+    return result
+
+
+def recomputed_weekday_stats(store):
+    """
+    Computes weekday statistics in pure Python from store columns.
+    """
+    store.weekdays = dict(
+        (user_id, store.sum_weekdays(user_id)) for user_id in store
+    )
+    return vectorized.python_weekday_stats(store)
+
+
+def bench_weekday_stats(users=1000, days=5000, repeat=1):
+    """
+    Compares weekday statistics engines on synthetic data.
+    """
+    store = synthetic_store(users, days)
+    engines = [
+        ('legacy', legacy_weekday_stats),
+        ('python', recomputed_weekday_stats),
+    ]
+    if vectorized.numpy is not None:
+        engines.append(('numpy', vectorized.numpy_weekday_stats))
+
+    result = {'rows': len(store)}
+    for name, engine in engines:
+        result['{0}_weekday_stats_s'.format(name)] = best_of(
+            lambda: engine(store), repeat
+        )
+    return result
+
+
+def write_users_xml(path, users):
+    """
+    Writes users XML file with given number of users.
+    """
+    with open(path, 'w') as xml_file:
+        xml_file.write(
+            '<?xml version="1.0" encoding="UTF-8" ?>\n<intranet>\n'
+            '<server><host>localhost</host><protocol>https</protocol>'
+            '</server>\n<users>\n'
+        )
+        for user_id in xrange(users):
+            xml_file.write(
+                '<user id="{0}"><avatar>/api/images/users/{0}</avatar>'
+                '<name>User {0}</name></user>\n'.format(user_id)
+            )
+        xml_file.write('</users>\n</intranet>\n')
+
+
+def concurrent_throughput(function, threads=8, calls=100):
+    """
+    Returns number of function calls per second made from many threads.
+    """
+    def worker():
+        """
+        Calls function repeatedly.
+        """
+        for _ in xrange(calls):
+            function()
+
+    workers = [Thread(target=worker) for _ in xrange(threads)]
+    start = timeit.default_timer()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return threads * calls / (timeit.default_timer() - start)
+
+
+def bench_users_view(users=500, threads=8, calls=100):
+    """
+    Compares /api/v1/users throughput with and without parsed users cache.
+    """
+    tmpdir = tempfile.mkdtemp()
+    users_xml = settings.USERS_XML
+    settings.USERS_XML = os.path.join(tmpdir, 'users.xml')
+    write_users_xml(settings.USERS_XML, users)
+    client = app.test_client()
+
+    def uncached():
+        """
+        Requests users view after dropping parsed users and responses.
+        """
+        User.cache.clear()
+        RESPONSES.clear()
+        client.get('/api/v1/users')
+
+    try:
+        return {
+            'users_view_uncached_rps': concurrent_throughput(
+                uncached, threads, calls
+            ),
+            'users_view_cached_rps': concurrent_throughput(
+                lambda: client.get('/api/v1/users'), threads, calls
+            ),
+        }
+    finally:
+        settings.USERS_XML = users_xml
+        RESPONSES.clear()
+        shutil.rmtree(tmpdir)
+
+
+def write_presence_csv(path, users, days, seed=0):
+    """
+    Writes presence CSV file with random entries of given users and days.
+    """
+    generator = random.Random(seed)
+    first_day = date(2013, 1, 1)
+    dates = [
+        (first_day + timedelta(days=i)).isoformat() for i in xrange(days)
+    ]
+    with open(path, 'w') as csvfile:
+        for user_id in xrange(users):
+            for day in dates:
+                start = generator.randint(6 * 3600, 11 * 3600)
+                end = start + generator.randint(3600, 10 * 3600)
+                csvfile.write('{0},{1},{2},{3}\n'.format(
+                    user_id, day, format_seconds(start), format_seconds(end),
+                ))
+
+
+def format_seconds(seconds):
+    """
+    Formats amount of seconds since midnight as HH:MM:SS.
+    """
+    return '{0:02d}:{1:02d}:{2:02d}'.format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60
+    )
+
+
+LOAD_SCRIPT = """
+import json, resource, sys, timeit
+from presence_analyzer.loader import PresenceLoader
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = timeit.default_timer()
+store = PresenceLoader(sys.argv[1]).load()
+seconds = timeit.default_timer() - start
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print json.dumps([len(store), seconds, before, after])
+"""
+"""Script loading CSV file in a fresh interpreter"""
+
+
+def bench_load(path):
+    """
+    Measures parse time and peak memory of loading given CSV file.
+
+    File is loaded in a fresh interpreter, so its peak resident memory
+    is not affected by earlier benchmarks.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    output = subprocess.check_output(
+        [sys.executable, '-c', LOAD_SCRIPT, path], env=env
+    )
+    rows, seconds, before, after = json.loads(output)
+    return {
+        'load_rows': rows,
+        'load_s': seconds,
+        'load_rows_per_s': rows / seconds,
+        # ru_maxrss is in kilobytes on Linux
+        'load_peak_memory_mb': after / 1024.0,
+        'load_memory_growth_mb': (after - before) / 1024.0,
+    }
+
+
+def endpoint_urls(user_ids):
+    """
+    Returns names and URLs of API endpoints benchmarked with given users.
+    """
+    user_id = user_ids[0]
+    bulk = '&'.join('user_id={0}'.format(i) for i in user_ids[:10])
+    return [
+        ('users', '/api/v1/users'),
+        ('mean_time_weekday', '/api/v1/mean_time_weekday/{0}'.format(user_id)),
+        ('presence_weekday', '/api/v1/presence_weekday/{0}'.format(user_id)),
+        (
+            'presence_start_end',
+            '/api/v1/presence_start_end/{0}'.format(user_id),
+        ),
+        (
+            'presence_weekday_range',
+            '/api/v1/presence_weekday/{0}?from=2013-03-01&to=2013-05-31'
+            .format(user_id),
+        ),
+        ('presence_weekday_bulk', '/api/v1/presence_weekday?' + bulk),
+        ('company_presence_weekday', '/api/v1/company/presence_weekday'),
+        (
+            'export_presence_csv',
+            '/api/v1/export/presence.csv?user_id={0}'.format(user_id),
+        ),
+    ]
+
+
+def bench_endpoints(path, requests=200):
+    """
+    Measures latency and throughput of API endpoints on given CSV file.
+
+    Every endpoint is requested with serialized response cache cleared
+    before each request and with responses served from the cache.
+    """
+    tmpdir = tempfile.mkdtemp()
+    data_csv = app.config.get('DATA_CSV')
+    users_xml = settings.USERS_XML
+    app.config['DATA_CSV'] = path
+    get_data.cache.clear()
+    client = app.test_client()
+    try:
+        user_ids = sorted(get_data())
+        settings.USERS_XML = os.path.join(tmpdir, 'users.xml')
+        write_users_xml(settings.USERS_XML, len(user_ids))
+
+        results = {}
+        for name, url in endpoint_urls(user_ids):
+            for variant, clear in (('uncached', True), ('cached', False)):
+                timings = []
+                for _ in xrange(requests):
+                    if clear:
+                        RESPONSES.clear()
+                    start = timeit.default_timer()
+                    response = client.get(url)
+                    response.get_data()
+                    timings.append(timeit.default_timer() - start)
+                    assert response.status_code == 200, url
+
+                timings.sort()
+                prefix = 'endpoint_{0}_{1}_'.format(name, variant)
+                results[prefix + 'p50_ms'] = timings[len(timings) // 2] * 1000
+                results[prefix + 'p95_ms'] = (
+                    timings[int(len(timings) * 0.95)] * 1000
+                )
+                results[prefix + 'rps'] = len(timings) / sum(timings)
+        return results
+    finally:
+        app.config['DATA_CSV'] = data_csv
+        settings.USERS_XML = users_xml
+        get_data.cache.clear()
+        RESPONSES.clear()
+        shutil.rmtree(tmpdir)
+
+
+SERVER_SCRIPT = """
+import sys
+from presence_analyzer import app
+from presence_analyzer.utils import get_data
+mode, path, port, workers = sys.argv[1:]
+app.config['DATA_CSV'] = path
+if mode == 'paste':
+    from paste.httpserver import serve
+    get_data()
+    serve(app, port=port, use_threadpool=True, threadpool_workers=workers)
+else:
+    from presence_analyzer.server import serve
+    serve(app, port=port, connections=workers)
+"""
+"""Script serving application on given port in a fresh interpreter"""
+
+
+def free_port():
+    """
+    Returns number of TCP port that is not in use.
+    """
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def wait_for(url, timeout=60):
+    """
+    Waits until given URL responds.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return urllib2.urlopen(url).read()
+        except (urllib2.URLError, socket.error):
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def bench_servers(path, clients=32, calls=50):
+    """
+    Compares throughput of threaded Paste server and asynchronous server.
+
+    Servers run in fresh interpreters and serve API endpoints to many
+    concurrent clients. Paste server gets 50 workers, like in deploy.ini.
+    Asynchronous server is skipped when gevent is not installed.
+    """
+    modes = [('paste', 50)]
+    if server.WSGIServer is not None:
+        modes.append(('async', 1000))
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    results = {}
+    with open(os.devnull, 'w') as devnull:
+        for mode, workers in modes:
+            port = free_port()
+            process = subprocess.Popen(
+                [
+                    sys.executable, '-c', SERVER_SCRIPT,
+                    mode, path, str(port), str(workers),
+                ],
+                env=env, stdout=devnull, stderr=devnull,
+            )
+            try:
+                base = 'http://127.0.0.1:{0}'.format(port)
+                wait_for(base + '/api/v1/company/presence_weekday')
+                user_ids = sorted(get_data())
+                urls = [
+                    base + url for name, url in endpoint_urls(user_ids)
+                    if name != 'users'
+                ]
+                position = iter(xrange(clients * calls))
+
+                def request():
+                    """
+                    Requests next of the endpoints.
+                    """
+                    url = urls[next(position) % len(urls)]
+                    urllib2.urlopen(url).read()
+
+                results['server_{0}_rps'.format(mode)] = (
+                    concurrent_throughput(request, clients, calls)
+                )
+            finally:
+                process.terminate()
+                process.wait()
+
+    if 'server_async_rps' in results:
+        results['server_async_speedup'] = (
+            results['server_async_rps'] / results['server_paste_rps']
+        )
+    return results
+
+
+def git_revision():
+    """
+    Returns hash of checked out commit or None outside of git repository.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=devnull,
+            ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+BENCHMARKS = (
+    'load', 'endpoints', 'servers', 'parsers', 'weekday_stats', 'users_view',
+)
+"""Names of benchmarks, in order they are run"""
+
+
+def run_suite(args):
+    """
+    Runs selected benchmarks and returns their results with metadata.
+    """
+    tmpdir = None
+    path = args.csv
+    if path is None:
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'presence.csv')
+        write_presence_csv(path, args.users, args.days)
+
+    benchmarks = {
+        'load': lambda: bench_load(path),
+        'endpoints': lambda: bench_endpoints(path, args.requests),
+        'servers': lambda: bench_servers(path),
+        'parsers': lambda: bench_parsers(path, repeat=3),
+        'weekday_stats': lambda: bench_weekday_stats(args.users, args.days),
+        'users_view': lambda: bench_users_view(args.users),
+    }
+    results = {}
+    data_csv = app.config.get('DATA_CSV')
+    app.config['DATA_CSV'] = path
+    try:
+        for name in args.only or BENCHMARKS:
+            results.update(benchmarks[name]())
+    finally:
+        app.config['DATA_CSV'] = data_csv
+        get_data.cache.clear()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'numpy': vectorized.numpy is not None,
+            'csv': args.csv,
+            'users': args.users,
+            'days': args.days,
+            'requests': args.requests,
+        },
+        'results': results,
+    }
+
+
+def compare(old, new):
+    """
+    Returns lines comparing results of two benchmark runs.
+    """
+    lines = []
+    for name in sorted(set(old['results']) & set(new['results'])):
+        before, after = old['results'][name], new['results'][name]
+        change = (after - before) / before * 100 if before else 0
+        lines.append('{0}: {1:.4f} -> {2:.4f} ({3:+.1f}%)'.format(
+            name, before, after, change
+        ))
+    return lines
+
+
+def parse_args(argv):
+    """
+    Parses command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Presence benchmarks')
+    parser.add_argument(
+        'csv', nargs='?',
+        help='CSV file to benchmark, synthetic one is generated by default',
+    )
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--days', type=int, default=1000)
+    parser.add_argument(
+        '--requests', type=int, default=200,
+        help='number of requests of every endpoint',
+    )
+    parser.add_argument(
+        '--only', action='append', choices=BENCHMARKS,
+        help='run only given benchmark, may be repeated',
+    )
+    parser.add_argument('--output', help='write JSON results to file')
+    parser.add_argument(
+        '--compare', metavar='FILE',
+        help='print changes against JSON results of earlier run',
+    )
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    """
+    Runs benchmarks and prints results.
+    """
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    report = run_suite(args)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as old:
+            print '\n'.join(compare(json.load(old), report))
+    elif not args.output:
+        print json.dumps(report, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory cache of computed values.
+"""
+import time
+from collections import OrderedDict
+from threading import Lock, Thread
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class Cache(object):
+    """
+    Bounded LRU cache with time-to-live of entries.
+
+    Concurrent misses of the same key are computed once, while values of
+    other keys can be computed at the same time. Entries expired less than
+    stale seconds ago are still served by get_or_compute while a background
+    thread computes their new values. With background disabled no such
+    thread is started, owner of the cache refreshes entries itself, see
+    refresh_expired.
+
+    With max_bytes set, values are sized with len() and least recently used
+    entries are evicted to keep their total size within the budget.
+
+    Values can be stored with a stamp identifying state of data they were
+    computed from. Value looked up with a different stamp is expired, no
+    matter how old it is.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self, timeout=600, max_entries=128, stale=0, max_bytes=None,
+            background=True,
+    ):
+        """
+        Sets up empty cache.
+        """
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.stale = stale
+        self.background = background
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.refreshing = set()
+        # key: (created, value, size, stamp), oldest first
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.key_locks = {}  # key: [lock, number of threads using it]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+
+    def get(self, key, default=None, stamp=None):
+        """
+        Returns fresh value of given key and stamp or default one.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if not self.is_fresh(entry, stamp):
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            # mark entry as most recently used
+            del self.entries[key]
+            self.entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value, stamp=None):
+        """
+        Stores value of given key, evicting least recently used entries.
+        """
+        size = len(value) if self.max_bytes is not None else 0
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[2]
+            self.entries[key] = (time.time(), value, size, stamp)
+            self.size += size
+            while self.entries and (
+                    len(self.entries) > self.max_entries or
+                    self.max_bytes is not None and self.size > self.max_bytes
+            ):
+                self.size -= self.entries.popitem(last=False)[1][2]
+                self.evictions += 1
+
+    def get_or_compute(self, key, function, stamp=None):
+        """
+        Returns value of given key and stamp, computing it with function on
+        miss.
+        """
+        missing = object()
+        value = self.get(key, missing, stamp)
+        if value is not missing:
+            return value
+
+        value = self.get_stale(key, function, missing, stamp)
+        if value is not missing:
+            return value
+
+        key_lock = self.acquire(key)
+        try:
+            # value may have been computed while waiting for the lock
+            with self.lock:
+                entry = self.entries.get(key)
+            if self.is_fresh(entry, stamp):
+                return entry[1]
+
+            value = function()
+            self.set(key, value, stamp)
+            return value
+        finally:
+            self.release(key, key_lock)
+
+    def is_fresh(self, entry, stamp):
+        """
+        Checks whether entry exists, is not expired and matches stamp.
+        """
+        return (
+            entry is not None and
+            entry[3] == stamp and
+            time.time() - entry[0] < self.timeout
+        )
+
+    def get_stale(self, key, function, default=None, stamp=None):
+        """
+        Returns expired value of given key, scheduling its refresh.
+
+        Values with different stamp are served as well, until they get
+        older than the stale period.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if (
+                    entry is None or
+                    not self.stale or
+                    time.time() - entry[0] >= self.timeout + self.stale
+            ):
+                return default
+
+            self.stale_hits += 1
+            if self.background and key not in self.refreshing:
+                self.refreshing.add(key)
+                thread = Thread(
+                    target=self.refresh, args=(key, function, stamp)
+                )
+                thread.daemon = True
+                thread.start()
+            return entry[1]
+
+    def refresh_expired(self, key, function, stamp=None):
+        """
+        Computes new value of given key and stamp unless cached one is fresh.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+        if not self.is_fresh(entry, stamp):
+            self.refresh(key, function, stamp)
+
+    def refresh(self, key, function, stamp=None):
+        """
+        Computes new value of given key and stamp.
+        """
+        key_lock = self.acquire(key)
+        try:
+            self.set(key, function(), stamp)
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Refreshing of %r failed', key)
+        finally:
+            self.release(key, key_lock)
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def acquire(self, key):
+        """
+        Acquires lock of given key.
+        """
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, [Lock(), 0])
+            key_lock[1] += 1
+        key_lock[0].acquire()
+        return key_lock
+
+    def release(self, key, key_lock):
+        """
+        Releases lock of given key, dropping it when no longer used.
+        """
+        key_lock[0].release()
+        with self.lock:
+            key_lock[1] -= 1
+            if not key_lock[1]:
+                del self.key_locks[key]
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Returns cache counters.
+        """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'stale_hits': self.stale_hits,
+            }
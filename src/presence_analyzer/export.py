@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Streamed exports of presence data.
+
+Exports are generators of text chunks, every chunk holds at most
+chunk_size records, so memory use does not depend on size of the export.
+"""
+import calendar
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date
+from json import dumps
+
+from presence_analyzer.store import time_from_seconds
+
+
+PRESENCE_FIELDS = ('user_id', 'date', 'start', 'end')
+"""Fields of exported presence entries"""
+
+WEEKDAY_FIELDS = ('user_id', 'weekday', 'count', 'presence', 'start', 'end')
+"""Fields of exported weekday aggregates, start and end are mean ones"""
+
+
+def presence_records(store, user_ids, first=None, last=None):
+    """
+    Yields presence entries of given users between two day ordinals.
+
+    Entries of every user are found with binary search over the user's
+    slice of days column, bounds are inclusive and optional.
+    """
+    for user_id in user_ids:
+        lower, upper = store.index.get(user_id, (0, 0))
+        if first is not None:
+            lower = bisect_left(store.days, first, lower, upper)
+        if last is not None:
+            upper = bisect_right(store.days, last, lower, upper)
+
+        for i in xrange(lower, upper):
+            yield (
+                user_id,
+                date.fromordinal(store.days[i]).isoformat(),
+                time_from_seconds(store.starts[i]).isoformat(),
+                time_from_seconds(store.ends[i]).isoformat(),
+            )
+
+
+def weekday_records(store, user_ids, first=None, last=None):
+    """
+    Yields weekday aggregates of given users between two day ordinals.
+    """
+    for user_id in user_ids:
+        if user_id not in store:
+            continue
+        weekdays = store.range_weekdays(user_id, first, last)
+        for weekday, (count, total, starts, ends) in enumerate(weekdays):
+            if count:
+                yield (
+                    user_id,
+                    calendar.day_abbr[weekday],
+                    count,
+                    total,
+                    starts // count,
+                    ends // count,
+                )
+
+
+def csv_chunks(fields, records, chunk_size=1024):
+    """
+    Yields CSV header line and lines of records in chunks.
+
+    Exported values never contain commas or quotes, so they are not quoted.
+    """
+    yield ','.join(fields) + '\n'
+    lines = []
+    for record in records:
+        lines.append(','.join(str(value) for value in record) + '\n')
+        if len(lines) == chunk_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+
+def ndjson_chunks(fields, records, chunk_size=1024):
+    """
+    Yields records as newline delimited JSON objects in chunks.
+    """
+    lines = []
+    for record in records:
+        lines.append(dumps(OrderedDict(zip(fields, record))) + '\n')
+        if len(lines) == chunk_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+
+FORMATS = {
+    'csv': (csv_chunks, 'text/csv'),
+    'ndjson': (ndjson_chunks, 'application/x-ndjson'),
+}
+"""Chunk generator and mimetype of every export format"""
+
+EXPORTS = {
+    'presence': (PRESENCE_FIELDS, presence_records),
+    'weekdays': (WEEKDAY_FIELDS, weekday_records),
+}
+"""Fields and record generator of every export"""
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Background fetching of users XML file.
+"""
+import os
+import stat
+import tempfile
+from threading import Event, Lock, Thread
+
+from lxml import etree
+import requests
+
+from presence_analyzer import settings
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class UsersFetcher(object):
+    """
+    Keeps local copy of users XML file up to date.
+
+    Requests are conditional, so unchanged file is not downloaded again.
+    The local copy is replaced atomically and only with valid XML, so
+    readers always see the last good copy.
+    """
+
+    def __init__(self, url=None, path=None, interval=3600, timeout=(3, 10)):
+        """
+        Sets up fetcher, url and path default to ones from settings.
+        """
+        self.url = url
+        self.path = path
+        self.interval = interval
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.etag = None
+        self.last_modified = None
+        self.lock = Lock()
+        self.thread_lock = Lock()
+        self.woken = Event()
+        self.thread = None
+
+    def fetch(self):
+        """
+        Downloads users XML file if it changed.
+
+        Returns True when local copy was replaced.
+        """
+        url = self.url or settings.USERS_XML_SOURCE
+        path = self.path or settings.USERS_XML
+        with self.lock:
+            headers = {}
+            if os.path.isfile(path):
+                # validators are only sent as the server gave them, clock
+                # of this host has nothing to do with server's one
+                if self.etag:
+                    headers['If-None-Match'] = self.etag
+                if self.last_modified:
+                    headers['If-Modified-Since'] = self.last_modified
+
+            try:
+                response = self.session.get(
+                    url, headers=headers, timeout=self.timeout
+                )
+            except requests.RequestException:
+                log.warning('Cannot fetch %s', url, exc_info=True)
+                return False
+
+            if response.status_code == 304:
+                return False
+            if not response.ok:
+                log.warning('Cannot fetch %s: %s', url, response.status_code)
+                return False
+
+            try:
+                etree.fromstring(response.content)
+            except etree.XMLSyntaxError:
+                log.warning('Invalid XML fetched from %s', url, exc_info=True)
+                return False
+
+            try:
+                write_atomically(path, response.content)
+            except EnvironmentError:
+                log.warning('Cannot write %s', path, exc_info=True)
+                return False
+
+            self.etag = response.headers.get('ETag')
+            self.last_modified = response.headers.get('Last-Modified')
+            return True
+
+    def start(self):
+        """
+        Starts fetching in background thread, unless it is running.
+
+        Returns True when thread was started.
+        """
+        with self.thread_lock:
+            if self.thread is not None and self.thread.is_alive():
+                return False
+
+            self.thread = Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+            return True
+
+    def wake(self):
+        """
+        Makes background thread fetch file now.
+        """
+        if not self.start():
+            self.woken.set()
+
+    def run(self):
+        """
+        Fetches file every interval seconds or when woken up.
+        """
+        while True:
+            self.woken.clear()
+            self.fetch()
+            self.woken.wait(self.interval)
+
+
+def file_mode(path):
+    """
+    Returns permission bits of given file, or default ones of new files.
+    """
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def write_atomically(path, content):
+    """
+    Replaces file content, readers see either old or new content.
+
+    Replaced file keeps its permissions, new file gets default ones.
+    """
+    directory, name = os.path.split(path)
+    descriptor, temp_path = tempfile.mkstemp(prefix=name, dir=directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as temp_file:
+            temp_file.write(content)
+        # temporary files are only readable by their owner
+        os.chmod(temp_path, file_mode(path))
+        os.rename(temp_path, path)
+    except EnvironmentError:
+        os.remove(temp_path)
+        raise
+
+
+FETCHER = UsersFetcher()
+"""Fetcher of users XML file specified in settings"""
@@ -0,0 +1,738 @@
+# -*- coding: utf-8 -*-
+"""
+Loading of presence data from CSV files.
+"""
+import glob
+import hashlib
+import multiprocessing
+import os
+from array import array
+from collections import Counter
+from datetime import date
+from threading import Lock
+from timeit import default_timer
+
+from presence_analyzer.snapshot import (
+    is_snapshot_file,
+    read_snapshot,
+    snapshot_lock,
+    write_snapshot,
+)
+from presence_analyzer.store import PresenceStore, time_from_seconds
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+REJECTIONS = (
+    'malformed', 'time_out_of_range', 'end_before_start', 'duplicate',
+)
+"""Reasons of rejecting lines of CSV files"""
+
+
+MAX_USER_ID = 2 ** 31 - 1
+"""Largest user id fitting in int32 column of PresenceStore"""
+
+
+class RejectedRow(ValueError):
+    """
+    Line of CSV file failed validation for given reason.
+    """
+
+    def __init__(self, reason, message):
+        """
+        Sets up error of one of REJECTIONS reasons.
+        """
+        super(RejectedRow, self).__init__(message)
+        self.reason = reason
+
+
+def parse_date(text):
+    """
+    Converts YYYY-MM-DD string into date ordinal.
+    """
+    if len(text) != 10 or text[4] != '-' or text[7] != '-':
+        raise ValueError('Invalid date: {}'.format(text))
+    return date(int(text[:4]), int(text[5:7]), int(text[8:])).toordinal()
+
+
+def parse_time(text):
+    """
+    Converts HH:MM:SS string into amount of seconds since midnight.
+    """
+    if (
+            len(text) != 8 or text[2] != ':' or text[5] != ':' or
+            not (text[:2] + text[3:5] + text[6:]).isdigit()
+    ):
+        raise ValueError('Invalid time: {}'.format(text))
+
+    hour, minute, second = int(text[:2]), int(text[3:5]), int(text[6:])
+    if hour > 23 or minute > 59 or second > 59:
+        raise RejectedRow(
+            'time_out_of_range', 'Time out of range: {}'.format(text)
+        )
+    return hour * 3600 + minute * 60 + second
+
+
+def parse_presence_rows(lines, first_line=0, rejected=None):
+    """
+    Parses lines in id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS layout.
+
+    Yields (user_id, day, start, end) tuples with day as date ordinal and
+    start/end as seconds since midnight. Lines are validated here, once,
+    so parsed data needs no further checks. Invalid lines are logged and
+    skipped, empty ones are ignored.
+
+    With rejected list given, (line number, reason, line) of every invalid
+    line is appended to it, reason is one of REJECTIONS. Lines are numbered
+    from first_line + 1. When the same user and day occur more than once,
+    the last line wins, like in PresenceStore.from_rows, and earlier ones
+    are rejected as duplicates.
+    """
+    days = {}  # the same dates repeat for every user
+    # packed user_id and day: packed number, start and end of the last line,
+    # plain ints take much less memory than tuples
+    seen = {}
+    for number, line in enumerate(lines, first_line + 1):
+        text = line.rstrip('\r\n')
+        if not text:
+            continue
+
+        row = text.split(',')
+        try:
+            if len(row) != 4:
+                raise ValueError('Expected 4 fields: {0}'.format(text))
+            user_id = int(row[0])
+            if not 0 <= user_id <= MAX_USER_ID:
+                raise ValueError('Invalid user id: {0}'.format(row[0]))
+            day = days.get(row[1])
+            if day is None:
+                day = days[row[1]] = parse_date(row[1])
+            start = parse_time(row[2])
+            end = parse_time(row[3])
+            if end < start:
+                raise RejectedRow(
+                    'end_before_start', 'End before start: {0}'.format(text)
+                )
+        except ValueError as error:
+            log.debug('Problem with line %d: ', number, exc_info=True)
+            if rejected is not None:
+                rejected.append(
+                    (number, getattr(error, 'reason', 'malformed'), text)
+                )
+            continue
+
+        if rejected is not None:
+            key = user_id << 22 | day  # ordinals of dates are below 2 ** 22
+            previous = seen.get(key)
+            if previous is not None:
+                rejected.append((
+                    previous >> 34,
+                    'duplicate',
+                    format_row(
+                        user_id, day, previous >> 17 & 0x1ffff,
+                        previous & 0x1ffff,
+                    ),
+                ))
+            # seconds since midnight are below 2 ** 17
+            seen[key] = number << 34 | start << 17 | end
+
+        yield user_id, day, start, end
+
+
+def format_row(user_id, day, start, end):
+    """
+    Formats parsed row as line of CSV file.
+    """
+    return '{0},{1},{2},{3}'.format(
+        user_id,
+        date.fromordinal(day).isoformat(),
+        time_from_seconds(start).isoformat(),
+        time_from_seconds(end).isoformat(),
+    )
+
+
+def read_presence_file(path, offset=0, first_line=0, end=None):
+    """
+    Parses presence CSV file starting at given byte offset.
+
+    Returns tuple of (store, offset, line, rejected) where offset and line
+    point right after the last complete, newline terminated, line that was
+    read and rejected is a list of (line number, reason, line) of invalid
+    lines. Parsed rows go straight into store columns. With end given,
+    reading stops at the first line starting at or after it.
+    """
+    consumed = [offset, first_line]
+
+    def count_lines(csvfile):
+        """
+        Passes lines through, counting complete ones.
+        """
+        for line in csvfile:
+            if end is not None and consumed[0] >= end:
+                break
+            if line.endswith('\n'):
+                consumed[0] += len(line)
+                consumed[1] += 1
+            yield line
+
+    rejected = []
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(offset)
+        store = PresenceStore.from_rows(
+            parse_presence_rows(count_lines(csvfile), first_line, rejected)
+        )
+
+    # incomplete last line is parsed again when the rest of it is appended
+    rejected = sorted(
+        record for record in rejected if record[0] <= consumed[1]
+    )
+    return store, consumed[0], consumed[1], rejected
+
+
+def find_lines(path, keys, offset=0, first_line=0, end=None):
+    """
+    Finds the last valid line of every (user_id, day) key in CSV file.
+
+    Lines are read from given byte offset up to the first line starting at
+    or after end and numbered like in read_presence_file. Returns dict of
+    key: line number of keys that were found.
+    """
+    found = {}
+    days = {}
+    position = offset
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(offset)
+        for number, line in enumerate(csvfile, first_line + 1):
+            if end is not None and position >= end:
+                break
+            position += len(line)
+
+            # cheap check of user and day before validating the whole line
+            row = line.split(',', 2)
+            try:
+                if row[1] not in days:
+                    days[row[1]] = parse_date(row[1])
+                key = int(row[0]), days[row[1]]
+            except (IndexError, ValueError):
+                continue
+            if key in keys and any(parse_presence_rows([line])):
+                found[key] = number
+    return found
+
+
+def superseded_lines(path, superseded, offset=0, first_line=0, end=None):
+    """
+    Returns rejected lines of rows replaced by later lines of CSV file.
+
+    Superseded is a sequence of (user_id, day, start, end) rows parsed from
+    given range of the file, see find_lines. Returns sorted list of (line
+    number, 'duplicate', line) like the one of read_presence_file.
+    """
+    if not superseded:
+        return []
+    numbers = find_lines(
+        path, set(row[:2] for row in superseded), offset, first_line, end
+    )
+    return sorted(
+        (numbers[row[:2]], 'duplicate', format_row(*row))
+        for row in superseded if row[:2] in numbers
+    )
+
+
+def chunk_ranges(path, size, chunks):
+    """
+    Splits first size bytes of file into byte ranges aligned to lines.
+
+    Returns list of (start, end) tuples, every range but the last one ends
+    right after a newline.
+    """
+    bounds = [0]
+    with open(path, 'rb') as csvfile:
+        for i in xrange(1, chunks):
+            position = max(size * i // chunks, bounds[-1] + 1)
+            csvfile.seek(position - 1)
+            csvfile.readline()
+            bounds.append(min(csvfile.tell(), size))
+    bounds.append(size)
+    return [
+        (start, end) for start, end in zip(bounds, bounds[1:]) if end > start
+    ]
+
+
+def pack_store(store):
+    """
+    Returns store as tuple of raw column bytes, index and weekdays.
+
+    Packed stores are cheap to send between processes.
+    """
+    columns = (store.user_ids, store.days, store.starts, store.ends)
+    return (
+        [column.tostring() for column in columns],
+        store.index,
+        store.weekdays,
+    )
+
+
+def unpack_store(packed):
+    """
+    Builds store packed with pack_store.
+    """
+    columns, index, weekdays = packed
+    return PresenceStore(
+        *[array('i', column) for column in columns],
+        index=index, weekdays=weekdays
+    )
+
+
+def parse_chunk(job):
+    """
+    Parses byte range of CSV file in worker process.
+
+    Job is a tuple of (path, start, end). Returns tuple of (packed store,
+    offset, number of lines, rejected lines) of the range. Line numbers of
+    rejected lines are relative to the start of the range.
+    """
+    path, start, end = job
+    store, offset, line, rejected = read_presence_file(path, start, end=end)
+    return pack_store(store), offset, line, rejected
+
+
+def read_presence_file_parallel(path, size, processes):
+    """
+    Parses the first size bytes of CSV file in worker processes.
+
+    Returns tuple of (store, offset, line, rejected), the same as
+    read_presence_file. Duplicates in different chunks are found while
+    chunks are combined and their lines are looked up afterwards.
+    """
+    jobs = [(path, start, end) for start, end in chunk_ranges(
+        path, size, processes
+    )]
+    results = map_processes(parse_chunk, jobs, processes)
+    superseded = []
+    store = PresenceStore.combine(
+        (unpack_store(packed) for packed, _, _, _ in results), superseded
+    )
+    line = 0
+    rejected = []
+    for i, (_, _, lines, chunk_rejected) in enumerate(results):
+        rejected.extend(
+            (number + line, reason, text)
+            for number, reason, text in chunk_rejected
+        )
+        rejected.extend(superseded_lines(
+            path, [row[1:] for row in superseded if row[0] == i],
+            jobs[i][1], line, jobs[i][2],
+        ))
+        line += lines
+    return store, results[-1][1], line, sorted(rejected)
+
+
+def map_processes(function, jobs, processes):
+    """
+    Maps jobs with function in pool of given number of worker processes.
+
+    Jobs are mapped in this process when there is less than two of them.
+    Functions run in forked workers must not take locks, like ones of
+    logging, which another thread could hold at the time of fork. Results
+    are logged by this process instead.
+    """
+    processes = min(processes, len(jobs))
+    if processes < 2:
+        return [function(job) for job in jobs]
+
+    pool = multiprocessing.Pool(processes, initializer=disable_logging)
+    try:
+        return pool.map(function, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def disable_logging():
+    """
+    Disables logging in worker process, without taking any of its locks.
+    """
+    logging.disable(logging.CRITICAL)
+
+
+def worker_count(processes):
+    """
+    Returns number of worker processes, 0 and None mean number of CPUs.
+    """
+    return processes or multiprocessing.cpu_count()
+
+
+class PresenceLoader(object):
+    """
+    Keeps presence data of one CSV file up to date.
+
+    Files are expected to be appended to, so after the first load only
+    the new tail of the file is parsed and merged into the store. The
+    whole file is parsed again when it was truncated or replaced.
+    """
+    marker_size = 64
+    """Amount of bytes before offset used to detect rewritten files"""
+
+    chunk_size = 16 * 1024 * 1024
+    """Minimal amount of bytes parsed by one worker process"""
+
+    def __init__(self, path):
+        """
+        Sets up empty loader state.
+        """
+        self.path = path
+        self.store = None
+        self.identity = None
+        self.offset = 0
+        self.line = 0
+        self.rejected = []  # (line number, reason, line)
+        self.marker = ''
+        self.lock = Lock()
+        self.duration = None
+        self.reloads = Counter()
+
+    def load(self, snapshot=False, shared=False, processes=1):
+        """
+        Returns store with current content of the file.
+
+        With snapshot enabled, a binary snapshot kept next to the file is
+        used instead of parsing it, and written after the file was parsed.
+        Shared store is always mapped from the snapshot, so processes
+        loading the same file share its memory.
+
+        Whole file is parsed in chunks by given number of worker processes,
+        0 means one for every CPU. Appended lines are parsed in-process.
+
+        Duration of the last reload and number of reloads of every kind are
+        kept for metrics.
+        """
+        with self.lock:
+            stat = os.stat(self.path)
+            identity = (stat.st_ino, stat.st_size, stat.st_mtime)
+            if self.store is not None and identity == self.identity:
+                return self.store
+
+            start = default_timer()
+            if shared:
+                with snapshot_lock(self.path):
+                    loaded = read_snapshot(self.path, stat, shared=True)
+                    if loaded is not None:
+                        self.reloads['snapshot'] += 1
+                    else:
+                        changed = self.read(stat, True, processes, True)
+                        loaded = read_snapshot(self.path, stat, shared=True)
+                        loaded = loaded or changed
+            else:
+                loaded = self.read(stat, snapshot, processes)
+
+            self.store, self.offset, self.line, self.rejected = loaded
+            self.store.version = '{0:x}-{1:x}-{2:x}'.format(
+                stat.st_ino, stat.st_size, int(stat.st_mtime * 1000000)
+            )
+            self.identity = identity
+            self.marker = self.read_marker()
+            self.duration = default_timer() - start
+            return self.store
+
+    def read(self, stat, snapshot=False, processes=1, shared=False):
+        """
+        Reads changes of the file of given os.stat result.
+
+        Returns tuple of (store, offset, line, rejected). Appended lines
+        replace entries of the same user and day, lines of replaced entries
+        are rejected as duplicates, like when the whole file is read.
+        Snapshot of shared store includes weekday prefix columns, so they
+        are shared between processes too.
+        """
+        if self.store is not None and self.is_appended(stat):
+            update, offset, line, rejected = read_presence_file(
+                self.path, self.offset, self.line
+            )
+            log.debug(
+                'Read %d bytes appended to %s', offset - self.offset, self.path
+            )
+            superseded = []
+            store = self.store.extend(update, superseded)
+            # incomplete last line read before is parsed again, lines its
+            # entry replaced were rejected already
+            numbers = set(record[0] for record in self.rejected)
+            rejected.extend(
+                record for record in superseded_lines(
+                    self.path, superseded, end=self.offset
+                )
+                if record[0] not in numbers
+            )
+            log_rejected(self.path, rejected)
+            loaded = (
+                store, offset, line, sorted(self.rejected + rejected),
+            )
+            self.reloads['append'] += 1
+        else:
+            loaded = read_snapshot(self.path, stat) if snapshot else None
+            if loaded:
+                log.debug('Read snapshot of %s', self.path)
+                self.reloads['snapshot'] += 1
+                return loaded
+
+            processes = min(
+                worker_count(processes), stat.st_size // self.chunk_size
+            )
+            if processes > 1:
+                loaded = read_presence_file_parallel(
+                    self.path, stat.st_size, processes
+                )
+            else:
+                loaded = read_presence_file(self.path)
+            log.debug('Read %d bytes of %s', loaded[1], self.path)
+            log_rejected(self.path, loaded[3])
+            self.reloads['full'] += 1
+
+        if snapshot:
+            write_snapshot(
+                self.path, loaded[0], stat, *loaded[1:], prefixes=shared
+            )
+        return loaded
+
+    def is_appended(self, stat):
+        """
+        Checks whether the file only grew since it was read last time.
+
+        Incomplete last line parsed into an entry makes the whole file to
+        be read again, the rest of the line may change or invalidate it.
+        """
+        return (
+            stat.st_ino == self.identity[0] and
+            stat.st_size >= self.identity[1] and
+            self.read_marker() == self.marker and
+            not any(parse_presence_rows([self.read_tail()]))
+        )
+
+    def quarantine(self):
+        """
+        Returns (path, line number, reason, line) of every rejected line.
+        """
+        return [(self.path, ) + record for record in self.rejected]
+
+    def read_marker(self):
+        """
+        Reads bytes preceding current offset.
+        """
+        start = max(self.offset - self.marker_size, 0)
+        with open(self.path, 'rb') as csvfile:
+            csvfile.seek(start)
+            return csvfile.read(self.offset - start)
+
+    def read_tail(self):
+        """
+        Reads incomplete last line as it was when the file was read.
+        """
+        if self.identity[1] <= self.offset:
+            return ''
+        with open(self.path, 'rb') as csvfile:
+            csvfile.seek(self.offset)
+            return csvfile.read(self.identity[1] - self.offset)
+
+
+def log_rejected(path, rejected):
+    """
+    Logs summary of lines of CSV file rejected by validation.
+    """
+    if rejected:
+        log.warning(
+            'Rejected %d lines of %s, see /api/v1/admin/quarantine',
+            len(rejected), path,
+        )
+
+
+def is_sharded(path):
+    """
+    Checks whether path is a directory or glob pattern of CSV files.
+    """
+    return os.path.isdir(path) or glob.has_magic(path)
+
+
+def shard_paths(path):
+    """
+    Returns sorted paths of CSV files in directory or matching pattern.
+
+    Snapshots written next to the files are never matched.
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, '*.csv')
+    return sorted(
+        name for name in glob.glob(path) if not is_snapshot_file(name)
+    )
+
+
+def source_stamp(path):
+    """
+    Returns state of CSV file, directory or glob pattern of CSV files.
+
+    State is a tuple of (path, inode, size, mtime) of every file, it is
+    None when the CSV file is missing. Files of directory or pattern
+    removed while they are listed are left out.
+    """
+    sharded = is_sharded(path)
+    state = []
+    for name in shard_paths(path) if sharded else [path]:
+        try:
+            stat = os.stat(name)
+        except OSError:
+            if sharded:
+                continue
+            return None
+        state.append((name, stat.st_ino, stat.st_size, stat.st_mtime))
+    return tuple(state)
+
+
+def parse_shard(path):
+    """
+    Parses one CSV file in worker process.
+
+    Returns tuple of (path, os.stat result, packed store, offset, line,
+    rejected lines) of the file.
+    """
+    stat = os.stat(path)
+    store, offset, line, rejected = read_presence_file(path)
+    return path, stat, pack_store(store), offset, line, rejected
+
+
+class ShardedLoader(object):
+    """
+    Keeps presence data of many CSV files, like monthly ones, up to date.
+
+    Files are read from a directory or a glob pattern. Changed files are
+    parsed again in parallel by a pool of worker processes. Only the merged
+    store is kept in memory, so unchanged files are read from their
+    snapshots on reload, or parsed again when snapshots are disabled. Files
+    are merged in order of their names and entries of later files take
+    precedence over entries of the same user and day in earlier ones,
+    whose lines are rejected as duplicates.
+    """
+
+    def __init__(self, path):
+        """
+        Sets up empty loader state.
+        """
+        self.path = path
+        self.store = None
+        self.shards = {}  # path: (identity, rejected lines)
+        self.superseded = {}  # path: lines replaced by later files
+        self.identity = None
+        self.lock = Lock()
+        self.duration = None
+        self.reloads = Counter()
+
+    def load(self, snapshot=False, shared=False, processes=None):
+        """
+        Returns store with current content of the files.
+
+        With snapshot enabled, every file has its own binary snapshot,
+        mapped read-only while the files are merged. Merged store is never
+        shared between processes, so shared is ignored. Number of worker
+        processes 0 or None means one for every CPU.
+        """
+        # pylint: disable=unused-argument
+        with self.lock:
+            identity = source_stamp(self.path)
+            if identity is None:
+                raise OSError('Cannot read files of {0}'.format(self.path))
+            if self.store is not None and identity == self.identity:
+                return self.store
+
+            paths = [path for path, _, _, _ in identity]
+
+            start = default_timer()
+            changed = [
+                path for path, ino, size, mtime in identity
+                if self.shards.get(path, (None, ))[0] != (ino, size, mtime)
+            ]
+            shards = {}
+            stores = {}
+            parsed = []
+            for path in paths:
+                stat = os.stat(path)
+                loaded = None
+                if snapshot:
+                    loaded = read_snapshot(path, stat, shared=True)
+                if loaded is None:
+                    parsed.append(path)
+                else:
+                    stores[path] = loaded[0]
+                    shards[path] = (
+                        (stat.st_ino, stat.st_size, stat.st_mtime), loaded[3],
+                    )
+            # snapshots are written and rejected lines logged here, workers
+            # only parse
+            for path, stat, packed, offset, line, rejected in map_processes(
+                    parse_shard, parsed, worker_count(processes),
+            ):
+                stores[path] = unpack_store(packed)
+                if path in changed:
+                    log_rejected(path, rejected)
+                if snapshot:
+                    write_snapshot(
+                        path, stores[path], stat, offset, line, rejected
+                    )
+                shards[path] = (
+                    (stat.st_ino, stat.st_size, stat.st_mtime), rejected,
+                )
+            log.debug(
+                'Found %d changed files, parsed %d of %d files',
+                len(changed), len(parsed), len(paths),
+            )
+
+            superseded = []
+            store = PresenceStore.combine(
+                (stores[path] for path in paths), superseded
+            )
+            self.superseded = dict(
+                (path, superseded_lines(path, [
+                    row[1:] for row in superseded if row[0] == i
+                ]))
+                for i, path in enumerate(paths)
+            )
+            self.shards = shards
+            self.store = store
+            self.store.version = hashlib.sha1(repr(identity)).hexdigest()
+            self.identity = identity
+            self.duration = default_timer() - start
+            self.reloads['sharded'] += 1
+            return self.store
+
+    def quarantine(self):
+        """
+        Returns (path, line number, reason, line) of every rejected line.
+        """
+        return [
+            (path, ) + record
+            for path in sorted(self.shards)
+            for record in sorted(
+                self.shards[path][1] + self.superseded.get(path, [])
+            )
+        ]
+
+
+LOADERS = {}
+"""Presence loaders by CSV file path"""
+
+LOADERS_LOCK = Lock()
+
+
+def loader_for(path):
+    """
+    Returns presence loader of given CSV file, directory or glob pattern.
+
+    Loaders of other paths are dropped, so stores of previously configured
+    data source are not kept in memory.
+    """
+    with LOADERS_LOCK:
+        if path not in LOADERS:
+            LOADERS.clear()
+            if is_sharded(path):
+                LOADERS[path] = ShardedLoader(path)
+            else:
+                LOADERS[path] = PresenceLoader(path)
+        return LOADERS[path]
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation exposed in Prometheus text format.
+
+Hot paths only record observations into histograms. Counters that are
+already kept elsewhere, like cache statistics or loader state, are
+collected when metrics are rendered.
+"""
+from bisect import bisect_left
+from collections import Counter
+from threading import Lock
+
+
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0,
+)
+"""Default upper bounds of histogram buckets, in seconds"""
+
+
+def escape(value):
+    """
+    Escapes label value.
+    """
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('"', '\\"')
+        .replace('\n', '\\n')
+    )
+
+
+def format_labels(names, values, extra=()):
+    """
+    Formats label set, extra is sequence of (name, value) pairs.
+    """
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(name, escape(value)) for name, value in pairs
+    ))
+
+
+class Histogram(object):
+    """
+    Histogram of observed values, kept separately for every label set.
+    """
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        """
+        Sets up empty histogram.
+        """
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # labels: [count of every bucket and +Inf, sum]
+        self.lock = Lock()
+
+    def observe(self, value, *labels):
+        """
+        Records value under given label values.
+        """
+        position = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[position] += 1
+            counts[-1] += value
+
+    def render(self):
+        """
+        Returns lines of histogram in Prometheus text format.
+        """
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.description),
+            '# TYPE {0} histogram'.format(self.name),
+        ]
+        with self.lock:
+            values = sorted(
+                (labels, list(counts))
+                for labels, counts in self.values.iteritems()
+            )
+
+        for labels, counts in values:
+            cumulative = 0
+            bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name,
+                    format_labels(self.labels, labels, [('le', bound)]),
+                    cumulative,
+                ))
+            lines.append('{0}_sum{1} {2!r}'.format(
+                self.name, format_labels(self.labels, labels), counts[-1]
+            ))
+            lines.append('{0}_count{1} {2}'.format(
+                self.name, format_labels(self.labels, labels), cumulative
+            ))
+        return lines
+
+
+def render_samples(name, kind, description, labels, samples):
+    """
+    Returns lines of counter or gauge in Prometheus text format.
+
+    Samples are sequence of (label values, value) pairs.
+    """
+    lines = [
+        '# HELP {0} {1}'.format(name, description),
+        '# TYPE {0} {1}'.format(name, kind),
+    ]
+    for values, value in samples:
+        lines.append('{0}{1} {2!r}'.format(
+            name, format_labels(labels, values), value
+        ))
+    return lines
+
+
+REQUEST_DURATION = Histogram(
+    'presence_request_duration_seconds',
+    'Time of handling requests, until response body is returned.',
+    labels=('endpoint', 'status'),
+)
+
+STAGE_DURATION = Histogram(
+    'presence_stage_duration_seconds',
+    'Time spent in stages of API requests: view and JSON encoding.',
+    labels=('endpoint', 'stage'),
+)
+
+CALL_DURATION = Histogram(
+    'presence_call_duration_seconds',
+    'Time of calls of cached functions, like get_data, hits included.',
+    labels=('function', ),
+)
+
+CACHES = {}
+"""Caches by name, their statistics are exposed as metrics"""
+
+
+def render(loaders=()):
+    """
+    Returns all metrics in Prometheus text format.
+
+    Loaders are PresenceLoader objects of loaded CSV files.
+    """
+    lines = []
+    for histogram in (REQUEST_DURATION, STAGE_DURATION, CALL_DURATION):
+        lines.extend(histogram.render())
+
+    stats = sorted(
+        (name, cache.stats()) for name, cache in CACHES.items()
+    )
+    for key, kind, description in [
+            ('hits', 'counter', 'Cache lookups that found fresh value.'),
+            ('misses', 'counter', 'Cache lookups that found no value.'),
+            ('stale_hits', 'counter', 'Expired values served during refresh.'),
+            ('evictions', 'counter', 'Entries evicted to stay within limits.'),
+            ('entries', 'gauge', 'Entries kept in cache.'),
+            ('bytes', 'gauge', 'Size of values kept in cache.'),
+    ]:
+        suffix = '_total' if kind == 'counter' else ''
+        lines.extend(render_samples(
+            'presence_cache_{0}{1}'.format(key, suffix), kind, description,
+            ('cache', ), [((name, ), values[key]) for name, values in stats],
+        ))
+
+    loaders = sorted(
+        (loader for loader in loaders if loader.store is not None),
+        key=lambda loader: loader.path,
+    )
+    for name, kind, description, samples in [
+            (
+                'presence_dataset_rows', 'gauge', 'Loaded presence entries.',
+                [((loader.path, ), len(loader.store)) for loader in loaders],
+            ),
+            (
+                'presence_dataset_users', 'gauge',
+                'Users with presence entries.',
+                [
+                    ((loader.path, ), len(loader.store.index))
+                    for loader in loaders
+                ],
+            ),
+            (
+                'presence_reload_duration_seconds', 'gauge',
+                'Duration of the last reload of presence data.',
+                [((loader.path, ), loader.duration) for loader in loaders],
+            ),
+    ]:
+        lines.extend(
+            render_samples(name, kind, description, ('path', ), samples)
+        )
+
+    lines.extend(render_samples(
+        'presence_rejected_lines', 'gauge',
+        'Lines of presence data rejected by validation.',
+        ('path', 'reason'),
+        [
+            ((loader.path, reason), count)
+            for loader in loaders
+            for reason, count in sorted(Counter(
+                record[2] for record in loader.quarantine()
+            ).items())
+        ],
+    ))
+    lines.extend(render_samples(
+        'presence_reloads_total', 'counter', 'Reloads of presence data.',
+        ('path', 'kind'),
+        [
+            ((loader.path, kind), count)
+            for loader in loaders
+            for kind, count in sorted(loader.reloads.items())
+        ],
+    ))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+WSGI middleware.
+"""
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+from presence_analyzer import metrics
+from presence_analyzer.cache import Cache
+
+
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/x-javascript',
+)
+"""Prefixes of content types worth compressing"""
+
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+"""zlib window bits producing container of given content coding"""
+
+
+def compress(data, encoding, level=6):
+    """
+    Compresses data with given content coding.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+class GzipMiddleware(object):
+    """
+    Compresses responses according to Accept-Encoding request header.
+
+    Only complete responses with Content-Length of at least min_size bytes
+    are compressed, streamed responses are passed through. Compressed
+    bodies of responses with ETag, like API responses and static files,
+    are cached, so they are not compressed again on every request.
+    """
+
+    def __init__(self, app, min_size=1024, level=6, max_bytes=16777216):
+        """
+        Wraps WSGI application.
+        """
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.cache = Cache(
+            timeout=float('inf'),
+            max_entries=10000,
+            max_bytes=max_bytes,
+        )
+        metrics.CACHES['compressed_responses'] = self.cache
+
+    def __call__(self, environ, start_response):
+        """
+        Handles WSGI request.
+        """
+        encoding = self.negotiate(environ)
+        if encoding is None:
+            return self.app(environ, start_response)
+
+        # compressed variants have their own ETags, see etag_variant
+        suffix = '-{0}"'.format(encoding)
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH', '')
+        if suffix in if_none_match:
+            environ['HTTP_IF_NONE_MATCH'] = if_none_match.replace(suffix, '"')
+
+        response = []
+
+        def capture(status, headers, exc_info=None):
+            """
+            Delays start of the response until body is known.
+            """
+            response[:] = [status, Headers(headers), exc_info]
+            return lambda data: response.append(data)
+
+        body = self.app(environ, capture)
+        status, headers, exc_info = response[:3]
+        if status.startswith('304') and suffix in if_none_match:
+            self.etag_variant(headers, encoding)
+        if not self.is_compressible(status, headers):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return self.prepend(response[3:], body)
+
+        try:
+            data = ''.join(response[3:]) + ''.join(body)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+        if len(data) >= self.min_size:
+            etag = headers.get('ETag')
+            if etag is None:
+                data = compress(data, encoding, self.level)
+            else:
+                data = self.cache.get_or_compute(
+                    (encoding, etag),
+                    lambda: compress(data, encoding, self.level),
+                )
+                self.etag_variant(headers, encoding)
+            headers['Content-Encoding'] = encoding
+            headers['Content-Length'] = str(len(data))
+        headers.add('Vary', 'Accept-Encoding')
+
+        start_response(status, headers.to_wsgi_list(), exc_info)
+        return [data]
+
+    @staticmethod
+    def negotiate(environ):
+        """
+        Returns content coding preferred by client or None.
+        """
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return None
+        accept = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        best = max(('gzip', 'deflate'), key=lambda name: accept[name])
+        return best if accept[best] > 0 else None
+
+    @staticmethod
+    def is_compressible(status, headers):
+        """
+        Checks whether response of given status and headers can be compressed.
+        """
+        return (
+            status.startswith('200') and
+            'Content-Length' in headers and
+            'Content-Encoding' not in headers and
+            headers.get('Content-Type', '').startswith(COMPRESSIBLE_TYPES)
+        )
+
+    @staticmethod
+    def etag_variant(headers, encoding):
+        """
+        Marks ETag as belonging to compressed variant of the response.
+        """
+        etag = headers.get('ETag')
+        if etag is not None and etag.endswith('"'):
+            headers['ETag'] = '{0}-{1}"'.format(etag[:-1], encoding)
+
+    @staticmethod
+    def prepend(chunks, body):
+        """
+        Yields chunks written before body was returned, then the body.
+        """
+        try:
+            for chunk in chunks:
+                yield chunk
+            for chunk in body:
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
@@ -1,56 +1,93 @@
 from lxml import etree
-from os.path import isfile
-import requests
+from threading import Lock
+import os
 
 from presence_analyzer import settings
+from presence_analyzer.fetcher import FETCHER
 
 
 class User(object):
     """
     User model class
     """
+    cache = {}
+    """Parsed users by XML file path, with (mtime, size) of parsed file"""
+
+    cache_lock = Lock()
 
     @staticmethod
     def fetch_users_file():
         """
         Fetches users.xml file specified in settings file
         """
-        request = requests.get(settings.USERS_XML_SOURCE)
-        if request.ok:
-            with open(settings.USERS_XML, 'w') as users_file:
-                users_file.write(request.content)
-            return True
-
-        return False
+        return FETCHER.fetch()
 
     @staticmethod
     def get_data():
         """
         Gets users data from XML.
+
+        Parsed data is kept in memory until the file is modified. Missing
+        file is fetched in background, never in the request.
+        """
+        path = settings.USERS_XML
+        stamp = User.stamp()
+        if stamp is None:
+            FETCHER.wake()
+            return []
+
+        with User.cache_lock:
+            cached = User.cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        users = User.parse(path)
+        with User.cache_lock:
+            User.cache[path] = (stamp, users)
+        return users
+
+    @staticmethod
+    def stamp():
+        """
+        Returns (mtime, size) of users XML file or None when it is missing.
+        """
+        try:
+            stat = os.stat(settings.USERS_XML)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    @staticmethod
+    def parse(path):
+        """
+        Parses users XML file.
+
+        Elements are cleared as soon as they are read, so memory does not
+        grow with the number of users beyond the resulting list.
         """
+        server = {}
         users = []
+        with open(path, 'r') as xml_file:
+            elements = etree.iterparse(xml_file, tag=('server', 'user'))
+            for _, element in elements:
+                if element.tag == 'server':
+                    server = {
+                        'protocol': element.findtext('protocol'),
+                        'host': element.findtext('host'),
+                    }
+                else:
+                    users.append({
+                        'user_id': element.get('id'),
+                        'name': element.findtext('name'),
+                        'image_url': element.findtext('avatar'),
+                        'team': element.findtext('team'),
+                    })
 
-        if not (isfile(settings.USERS_XML) or User.fetch_users_file()):
-            return users
-
-        with open(settings.USERS_XML, 'r') as xml_file:
-            xml = etree.parse(xml_file)
-            root = xml.getroot()
-
-            server = root.find('server')
-            server_url = '{0}://{1}'.format(
-                server.find('protocol').text,
-                server.find('host').text,
-            )
-
-            for user in root.find('users'):
-                users.append({
-                    'user_id': user.get('id'),
-                    'name': user.find('name').text,
-                    'image_url': '{0}{1}'.format(
-                        server_url,
-                        user.find('avatar').text
-                    ),
-                })
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
 
+        server_url = '{0}://{1}'.format(server['protocol'], server['host'])
+        for user in users:
+            user['image_url'] = '{0}{1}'.format(server_url, user['image_url'])
         return users
@@ -12,6 +12,7 @@ import werkzeug.script
 etc = partial(os.path.join, 'parts', 'etc')
 
 DEPLOY_INI = etc('deploy.ini')
+ASYNC_INI = etc('async.ini')
 DEPLOY_CFG = etc('deploy.cfg')
 
 DEBUG_INI = etc('debug.ini')
@@ -26,10 +27,37 @@ del _buildout_path
 
 
 # bin/paster serve parts/etc/deploy.ini
+# bin/paster-async serve parts/etc/async.ini
 def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
     from presence_analyzer import app
+    from presence_analyzer.fetcher import FETCHER
+    from presence_analyzer.middleware import GzipMiddleware
+    from presence_analyzer.snapshot import numpy
+    from presence_analyzer.utils import get_data, RESPONSES
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    # Shared snapshot columns are NumPy views of the mapped file
+    if app.config.get('DATA_SHARED', False) and numpy is None:
+        app.logger.warning(
+            'DATA_SHARED needs NumPy, install presence_analyzer[numpy]; '
+            'every process keeps its own copy of presence data'
+        )
+        app.config['DATA_SHARED'] = False
+    # Dataset is rebuilt in background while expired one is served
+    get_data.cache.timeout = app.config.get('DATA_REFRESH_INTERVAL', 600)
+    get_data.cache.stale = app.config.get('DATA_MAX_STALENESS', 0)
+    RESPONSES.max_bytes = app.config.get(
+        'API_RESPONSE_CACHE_BYTES', RESPONSES.max_bytes
+    )
+    # Users XML file is kept up to date outside of requests
+    FETCHER.interval = app.config.get('USERS_XML_REFRESH_INTERVAL', 3600)
+    FETCHER.start()
+    if not isinstance(app.wsgi_app, GzipMiddleware):
+        app.wsgi_app = GzipMiddleware(
+            app.wsgi_app,
+            min_size=app.config.get('COMPRESS_MIN_SIZE', 1024),
+            level=app.config.get('COMPRESS_LEVEL', 6),
+        )
     return app
 
 
@@ -50,13 +78,14 @@ def make_shell():
     return locals()
 
 
-def _serve(action, debug=False, dry_run=False):
+def _serve(action, debug=False, dry_run=False, config=None):
     """Build paster command from 'action' and 'debug' flag."""
-    if debug:
+    if config is None and debug:
         config = DEBUG_INI
-    else:
+    elif config is None:
         config = DEPLOY_INI
-    argv = ['bin/paster', 'serve', config]
+    name = 'paster-async' if config == ASYNC_INI else 'paster'
+    argv = ['bin/' + name, 'serve', config]
     if action in ('start', 'restart'):
         argv += [action, '--daemon']
     elif action in ('', 'fg', 'foreground'):
@@ -70,8 +99,8 @@ def _serve(action, debug=False, dry_run=False):
     # Configure logging and lock file
     if action in ('start', 'stop', 'restart', 'status'):
         argv += [
-            '--log-file', abspath('var', 'log', 'paster.log'),
-            '--pid-file', abspath('var', 'log', '.paster.pid'),
+            '--log-file', abspath('var', 'log', name + '.log'),
+            '--pid-file', abspath('var', 'log', '.' + name + '.pid'),
         ]
     sys.argv = argv[:2] + [abspath(config)] + argv[3:]
     # Run the 'paster' command
@@ -95,6 +124,15 @@ def run():
         """
         _serve(action, debug=False, dry_run=dry_run)
 
+    # bin/flask-ctl-async async [fg|start|stop|restart|status]
+    def action_async(action=('a', 'start'), dry_run=False):
+        """Serve the application with asynchronous server.
+
+        Requests are handled by gevent event loop instead of threads.
+        Needs optional async part of buildout, which installs gevent.
+        """
+        _serve(action, dry_run=dry_run, config=ASYNC_INI)
+
     # bin/flask-ctl debug [fg|start|stop|restart|status]
     def action_debug(action=('a', 'start'), dry_run=False):
         """Serve the debugging application."""
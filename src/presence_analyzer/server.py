@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Event loop based HTTP server.
+
+Requests are handled by greenlets of a single gevent event loop instead
+of a pool of threads, which keeps many concurrent connections cheap.
+Standard library is not monkey patched, so data reloads, warm up of
+response cache and fetching of users XML file keep running in real
+threads, off the event loop. Flask context locals are bound to greenlets
+by Werkzeug, so views need no changes.
+
+gevent is optional, it is installed by async part of buildout. Serve with:
+bin/paster-async serve parts/etc/async.ini
+"""
+from threading import Event, Thread
+
+try:
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+except ImportError:  # pragma: no cover
+    Pool = WSGIServer = None  # pylint: disable=invalid-name
+
+from presence_analyzer.utils import get_data
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+REFRESH_INTERVAL = 1
+"""Seconds between checks whether presence data needs reload"""
+
+
+def make_server(app, host='0.0.0.0', port=15200, connections=1000):
+    """
+    Creates server of WSGI application handling given number of
+    connections at once.
+    """
+    if WSGIServer is None:
+        raise RuntimeError('gevent is required by asynchronous server')
+    return WSGIServer(
+        (host, int(port)), app, spawn=Pool(int(connections)), log=None
+    )
+
+
+def prepare_data(interval=REFRESH_INTERVAL):
+    """
+    Loads presence data and keeps reloading it in background thread.
+
+    Reload during request would block every connection of the event loop,
+    so requests are always served data that is already loaded, expired
+    one included, while a timer thread reloads it every time it expires or
+    its files change. Returns event stopping the thread.
+    """
+    get_data.cache.stale = float('inf')
+    get_data.cache.background = False
+    get_data()
+
+    stop = Event()
+    thread = Thread(target=refresh_data, args=(interval, stop))
+    thread.daemon = True
+    thread.start()
+    return stop
+
+
+def refresh_data(interval, stop):
+    """
+    Checks whether presence data needs reload every interval seconds.
+    """
+    while not stop.wait(interval):
+        try:
+            get_data.refresh()
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Refreshing of presence data failed')
+
+
+def serve(app, host='0.0.0.0', port=15200, connections=1000):
+    """
+    Serves WSGI application until interrupted.
+    """
+    server = make_server(app, host, port, connections)
+    prepare_data()
+    log.info('Serving on http://%s:%s', host, port)
+    server.serve_forever()
+
+
+# paster-async serve parts/etc/async.ini
+def server_runner(wsgi_app, global_conf, **kwargs):
+    """
+    Runs server with options from [server:main] section of Paste config.
+    """
+    # pylint: disable=unused-argument
+    serve(wsgi_app, **kwargs)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshots of parsed presence data.
+
+Snapshot is written next to the CSV file it was parsed from. It starts
+with a header followed by fixed-width records, all in native byte order:
+- user_ids, days, starts and ends columns, int32 each,
+- (user_id, lower, upper) offset index of every user, C long each,
+- 7 x (count, total, starts, ends) weekday aggregates of every user,
+  C long each,
+- days, int32, and starts and ends running sums, C long each, of
+  per-weekday prefix columns, when store has them,
+- marshalled list of (line number, reason, line) of rejected lines.
+"""
+import fcntl
+import marshal
+import mmap
+import os
+import re
+import struct
+import tempfile
+from array import array
+from contextlib import contextmanager
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # pylint: disable=invalid-name
+
+from presence_analyzer.store import PresenceStore
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+MAGIC = 'PRESENCE'
+"""First bytes of snapshot file"""
+
+VERSION = 4
+"""Version of snapshot format, bumped on every incompatible change"""
+
+HEADER = struct.Struct('=8sHHHQQQdQQQH')
+"""
+Magic, version, item sizes of int and long records, number of rows and
+users, size and mtime of CSV file, offset and line number after the last
+parsed line, size of rejected lines, whether prefix columns are included
+"""
+
+
+SNAPSHOT_FILE = re.compile(r'\.snapshot(\.lock|\w{6})?$')
+"""Name of snapshot, its lock or temporary file being written"""
+
+
+def snapshot_path(path):
+    """
+    Returns path of snapshot of given CSV file.
+    """
+    return path + '.snapshot'
+
+
+def is_snapshot_file(path):
+    """
+    Checks whether path is a snapshot, its lock or its temporary file.
+    """
+    return SNAPSHOT_FILE.search(os.path.basename(path)) is not None
+
+
+def write_snapshot(  # pylint: disable=too-many-arguments
+        path, store, stat, offset, line, rejected=(), prefixes=False,
+):
+    """
+    Writes snapshot of store parsed from CSV file of given os.stat result.
+
+    Rejected is a sequence of (line number, reason, line) of lines rejected
+    by validation. Weekday prefix columns are included when store already
+    has them, with prefixes enabled they are built first.
+
+    File is replaced atomically, so readers never see partial snapshots.
+    Failures are logged, snapshots are only an optimization.
+    """
+    users = sorted(store.index)
+    if prefixes:
+        store.weekday_prefixes()
+    rejected = marshal.dumps(list(rejected))
+    index = array('l')
+    weekdays = array('l')
+    for user_id in users:
+        index.extend(array('l', (user_id, ) + store.index[user_id]))
+        for sums in store.weekdays[user_id]:
+            weekdays.extend(array('l', sums))
+
+    directory, name = os.path.split(snapshot_path(path))
+    temp_path = None
+    try:
+        descriptor, temp_path = tempfile.mkstemp(prefix=name, dir=directory)
+        with os.fdopen(descriptor, 'wb') as snapshot:
+            snapshot.write(HEADER.pack(
+                MAGIC, VERSION, store.days.itemsize, index.itemsize,
+                len(store), len(users), stat.st_size, stat.st_mtime,
+                offset, line, len(rejected), store.prefixes is not None,
+            ))
+            for column in (
+                    store.user_ids, store.days, store.starts, store.ends,
+                    index, weekdays,
+            ) + (store.prefixes or ()):
+                snapshot.write(column.tostring())
+            snapshot.write(rejected)
+        os.rename(temp_path, snapshot_path(path))
+    except EnvironmentError:
+        log.warning('Cannot write snapshot of %s', path, exc_info=True)
+        if temp_path is not None and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+@contextmanager
+def snapshot_lock(path):
+    """
+    Holds exclusive lock of snapshot of given CSV file between processes.
+    """
+    with open(snapshot_path(path) + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_snapshot(path, stat, shared=False):
+    """
+    Reads snapshot of CSV file of given os.stat result.
+
+    Returns tuple of (store, offset, line, rejected) or None when there is
+    no valid snapshot of the file in its current state. Shared store and
+    prefix columns are read-only NumPy views of the mapped file, so every
+    process mapping the snapshot uses the same memory pages. Without NumPy
+    columns are copied.
+    """
+    try:
+        with open(snapshot_path(path), 'rb') as snapshot:
+            mapped = mmap.mmap(
+                snapshot.fileno(), 0, access=mmap.ACCESS_READ
+            )
+    except (EnvironmentError, ValueError):
+        return None
+
+    shared = shared and numpy is not None
+    try:
+        return load_mapped(mapped, stat, shared)
+    finally:
+        if not shared:
+            mapped.close()
+
+
+def load_mapped(mapped, stat, shared=False):
+    """
+    Builds store from memory-mapped snapshot.
+    """
+    if len(mapped) < HEADER.size:
+        return None
+
+    (
+        magic, version, int_size, long_size, rows, users, size, mtime,
+        offset, line, rejected_size, prefixes,
+    ) = HEADER.unpack_from(mapped)
+    prefix_rows = rows if prefixes else 0
+    if (
+            magic != MAGIC or version != VERSION or
+            int_size != array('i').itemsize or
+            long_size != array('l').itemsize or
+            len(mapped) != (
+                HEADER.size + (rows * 4 + prefix_rows) * int_size +
+                (users * 31 + prefix_rows * 2) * long_size + rejected_size
+            )
+    ):
+        log.warning('Ignoring invalid snapshot')
+        return None
+    if size != stat.st_size or mtime != stat.st_mtime:
+        return None
+
+    position = HEADER.size
+    columns = {}
+    for name, typecode, length in [
+            ('user_ids', 'i', rows),
+            ('days', 'i', rows),
+            ('starts', 'i', rows),
+            ('ends', 'i', rows),
+            ('index', 'l', users * 3),
+            ('weekdays', 'l', users * 28),
+            ('prefix_days', 'i', prefix_rows),
+            ('prefix_starts', 'l', prefix_rows),
+            ('prefix_ends', 'l', prefix_rows),
+    ]:
+        column = array(typecode)
+        end = position + length * column.itemsize
+        if shared and name not in ('index', 'weekdays') and length:
+            column = numpy.frombuffer(
+                mapped, numpy.intc if typecode == 'i' else numpy.int_,
+                count=length, offset=position,
+            )
+        else:
+            column.fromstring(mapped[position:end])
+        columns[name] = column
+        position = end
+
+    index = columns['index']
+    weekdays = columns['weekdays']
+    store = PresenceStore(
+        columns['user_ids'], columns['days'], columns['starts'],
+        columns['ends'],
+        weekdays=dict(
+            (
+                index[3 * i],
+                [
+                    list(weekdays[28 * i + 4 * day:28 * i + 4 * day + 4])
+                    for day in xrange(7)
+                ],
+            )
+            for i in xrange(users)
+        ),
+        index=dict(
+            (index[3 * i], (index[3 * i + 1], index[3 * i + 2]))
+            for i in xrange(users)
+        ),
+        prefixes=(
+            columns['prefix_days'], columns['prefix_starts'],
+            columns['prefix_ends'],
+        ) if prefixes else None,
+    )
+    return store, offset, line, marshal.loads(mapped[end:])
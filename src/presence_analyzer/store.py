@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar storage for presence data.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, time
+
+
+def weekday(day):
+    """
+    Returns weekday (Monday is 0) of given day ordinal.
+    """
+    return (day + 6) % 7
+
+
+def time_from_seconds(seconds):
+    """
+    Converts amount of seconds since midnight into datetime.time object.
+    """
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def sort_columns(user_ids, days, starts, ends):
+    """
+    Returns columns sorted by (user_id, day) without duplicates.
+
+    Sort is stable, so of rows of the same user and day the last one is
+    kept.
+    """
+    order = sorted(
+        xrange(len(days)), key=lambda i: user_ids[i] << 22 | days[i]
+    )
+    columns = [array('i') for _ in xrange(4)]
+    for position, i in enumerate(order):
+        if (
+                position + 1 < len(order) and
+                user_ids[order[position + 1]] == user_ids[i] and
+                days[order[position + 1]] == days[i]
+        ):
+            continue
+        for column, source in zip(columns, (user_ids, days, starts, ends)):
+            column.append(source[i])
+    return columns
+
+
+def append_prefixes(prefixes, entries):
+    """
+    Appends weekday prefix rows of one user to days, starts and ends
+    prefix columns.
+
+    Entries are (day, start, end) tuples of the user sorted by day.
+    """
+    days, starts, ends = prefixes
+    groups = [[] for _ in xrange(7)]
+    for entry in entries:
+        groups[weekday(entry[0])].append(entry)
+    start_sum = end_sum = 0
+    for group in groups:
+        for day, start, end in group:
+            start_sum += start
+            end_sum += end
+            days.append(day)
+            starts.append(start_sum)
+            ends.append(end_sum)
+
+
+def new_prefixes():
+    """
+    Returns empty days, starts and ends prefix columns.
+    """
+    return array('i'), array('l'), array('l')
+
+
+class PresenceStore(object):
+    """
+    Presence entries kept in parallel typed arrays.
+
+    Rows are sorted by (user_id, day) and every user owns a contiguous
+    slice of them, described by the per-user offset index. Days are
+    stored as date ordinals, start and end as seconds since midnight.
+
+    Per-user weekday aggregates and their company-wide totals are computed
+    once, when store is built. Store-wide per-weekday prefix columns, used
+    by date range queries, are built on first such query and carried over
+    to extended stores. Version identifies data source state the store was
+    loaded from.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self, user_ids, days, starts, ends, weekdays=None, index=None,
+            totals=None, prefixes=None,
+    ):
+        """
+        Wraps already sorted and deduplicated columns.
+
+        Offset index, weekday aggregates of users found in weekdays, their
+        totals and weekday prefix columns are reused as they are, when
+        given.
+        """
+        self.user_ids = user_ids
+        self.days = days
+        self.starts = starts
+        self.ends = ends
+        self.index = index
+        self.weekdays = {}
+        self.prefixes = prefixes
+        self.version = None
+
+        if index is None:
+            self.index = {}
+            lower = 0
+            for i in xrange(1, len(user_ids) + 1):
+                if i == len(user_ids) or user_ids[i] != user_ids[lower]:
+                    self.index[user_ids[lower]] = (lower, i)
+                    lower = i
+
+        weekdays = weekdays or {}
+        for user_id in self.index:
+            if user_id in weekdays:
+                self.weekdays[user_id] = weekdays[user_id]
+            else:
+                self.weekdays[user_id] = self.sum_weekdays(user_id)
+
+        self.totals = totals
+        if totals is None:
+            self.totals = self.rollup(self.index)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds store from iterable of (user_id, day, start, end) tuples.
+
+        Rows are appended straight into the columns, so rows already sorted
+        by (user_id, day), like in exported files, take no memory besides
+        them. Columns of unsorted rows are sorted afterwards. When the same
+        user and day occur more than once, the last row wins.
+        """
+        user_ids, days, starts, ends = (array('i') for _ in xrange(4))
+        ordered = True
+        last = -1
+        for user_id, day, start, end in rows:
+            key = user_id << 22 | day  # ordinals of dates are below 2 ** 22
+            if key == last and ordered:
+                starts[-1] = start
+                ends[-1] = end
+                continue
+            if key < last:
+                ordered = False
+            last = key
+            user_ids.append(user_id)
+            days.append(day)
+            starts.append(start)
+            ends.append(end)
+
+        if not ordered:
+            user_ids, days, starts, ends = sort_columns(
+                user_ids, days, starts, ends
+            )
+        return cls(user_ids, days, starts, ends)
+
+    def merge(self, rows, superseded=None):
+        """
+        Returns new store extended with given (user_id, day, start, end) rows.
+        """
+        return self.extend(PresenceStore.from_rows(rows), superseded)
+
+    def extend(self, update, superseded=None):
+        """
+        Returns new store extended with entries of another store.
+
+        New entries take precedence over entries of the same user and day.
+        Slices of users that received no entries are copied as they are and
+        totals are only corrected by aggregates of users that received them.
+        Prefix columns, when they were built, are rebuilt only for those
+        users too.
+
+        With superseded list given, (user_id, day, start, end) of every
+        entry replaced by a new one is appended to it.
+        """
+        if not len(update):
+            return self
+
+        columns = [array('i') for _ in xrange(4)]
+        weekdays = {}
+        prefixes = None if self.prefixes is None else new_prefixes()
+        for user_id in sorted(set(self.index) | set(update.index)):
+            if user_id not in update.index:
+                source = [(self, self.index[user_id])]
+                weekdays[user_id] = self.weekdays[user_id]
+            elif user_id not in self.index:
+                source = [(update, update.index[user_id])]
+                weekdays[user_id] = update.weekdays[user_id]
+            else:
+                old, new = self.index[user_id], update.index[user_id]
+                if self.days[old[1] - 1] < update.days[new[0]]:
+                    # usual case, only later days were appended
+                    source = [(self, old), (update, new)]
+                    weekdays[user_id] = [
+                        [a + b for a, b in zip(*sums)]
+                        for sums in zip(
+                            self.weekdays[user_id],
+                            update.weekdays[user_id],
+                        )
+                    ]
+                else:
+                    entries = dict(
+                        (day, (start, end))
+                        for day, start, end in self.entries(user_id)
+                    )
+                    for day, start, end in update.entries(user_id):
+                        if superseded is not None and day in entries:
+                            superseded.append(
+                                (user_id, day) + entries[day]
+                            )
+                        entries[day] = start, end
+                    merged = PresenceStore.from_rows(
+                        (user_id, day, start, end)
+                        for day, (start, end) in entries.iteritems()
+                    )
+                    source = [(merged, (0, len(merged)))]
+                    weekdays[user_id] = merged.weekdays[user_id]
+
+            position = len(columns[0])
+            for store, (lower, upper) in source:
+                store.copy_rows(columns, lower, upper)
+            if prefixes is None:
+                continue
+            if user_id in update.index:
+                append_prefixes(prefixes, zip(*(
+                    column[position:] for column in columns[1:]
+                )))
+            else:
+                self.copy_prefixes(prefixes, *self.index[user_id])
+
+        totals = [list(sums) for sums in self.totals]
+        for user_id in update.index:
+            old = self.weekdays.get(user_id, [[0, 0, 0, 0]] * 7)
+            for sums, old_sums, new_sums in zip(
+                    totals, old, weekdays[user_id]
+            ):
+                for i, (a, b) in enumerate(zip(old_sums, new_sums)):
+                    sums[i] += b - a
+
+        return PresenceStore(
+            *columns, weekdays=weekdays, totals=totals, prefixes=prefixes
+        )
+
+    @classmethod
+    def combine(cls, stores, superseded=None):
+        """
+        Builds store of entries of all given stores, merged by user.
+
+        Entries of later stores take precedence over entries of the same
+        user and day in earlier ones. Slices of users whose entries in
+        consecutive stores do not overlap, like in monthly files, are
+        copied as they are. Prefix columns are built when every store has
+        them, slices of users found in only one store are copied.
+
+        With superseded list given, (position of store, user_id, day, start,
+        end) of every entry replaced by one of a later store is appended to
+        it.
+        """
+        stores = [
+            (position, store)
+            for position, store in enumerate(stores) if len(store)
+        ]
+        columns = [array('i') for _ in xrange(4)]
+        weekdays = {}
+        prefixes = None
+        if all(store.prefixes is not None for _, store in stores):
+            prefixes = new_prefixes()
+        for user_id in sorted(
+                set().union(*(store.index for _, store in stores))
+        ):
+            positions = [
+                position for position, store in stores
+                if user_id in store.index
+            ]
+            source = [
+                (store, store.index[user_id])
+                for _, store in stores if user_id in store.index
+            ]
+            if all(
+                    store.days[upper - 1] < other.days[lower]
+                    for (store, (_, upper)), (other, (lower, _))
+                    in zip(source, source[1:])
+            ):
+                weekdays[user_id] = [
+                    [sum(values) for values in zip(*sums)]
+                    for sums in zip(*(
+                        store.weekdays[user_id] for store, _ in source
+                    ))
+                ]
+            else:
+                entries = {}  # day: (position of store, start, end)
+                for position, (store, _) in zip(positions, source):
+                    for day, start, end in store.entries(user_id):
+                        if superseded is not None and day in entries:
+                            superseded.append(
+                                entries[day][:1] + (user_id, day) +
+                                entries[day][1:]
+                            )
+                        entries[day] = position, start, end
+                merged = cls.from_rows(
+                    (user_id, day, start, end)
+                    for day, (_, start, end) in entries.iteritems()
+                )
+                source = [(merged, (0, len(merged)))]
+                weekdays[user_id] = merged.weekdays[user_id]
+
+            position = len(columns[0])
+            for store, (lower, upper) in source:
+                store.copy_rows(columns, lower, upper)
+            if prefixes is None:
+                continue
+            if len(positions) == 1:
+                source[0][0].copy_prefixes(prefixes, *source[0][1])
+            else:
+                append_prefixes(prefixes, zip(*(
+                    column[position:] for column in columns[1:]
+                )))
+
+        return cls(*columns, weekdays=weekdays, prefixes=prefixes)
+
+    def copy_rows(self, columns, lower, upper):
+        """
+        Appends rows between two positions to user_ids, days, starts and
+        ends arrays.
+        """
+        for column, source in zip(
+                columns, (self.user_ids, self.days, self.starts, self.ends)
+        ):
+            # copies raw bytes, columns may be arrays or NumPy views
+            column.fromstring(source[lower:upper].tostring())
+
+    def copy_prefixes(self, prefixes, lower, upper):
+        """
+        Appends prefix rows of one user between two positions to days,
+        starts and ends prefix columns.
+        """
+        for column, source in zip(prefixes, self.prefixes):
+            column.fromstring(source[lower:upper].tostring())
+
+    def __len__(self):
+        """
+        Returns number of stored entries.
+        """
+        return len(self.days)
+
+    def __contains__(self, user_id):
+        """
+        Checks whether user has any presence entries.
+        """
+        return user_id in self.index
+
+    def __iter__(self):
+        """
+        Iterates over user ids.
+        """
+        return iter(self.index)
+
+    def keys(self):
+        """
+        Returns list of user ids.
+        """
+        return self.index.keys()
+
+    def __getitem__(self, user_id):
+        """
+        Returns presence entries of given user as dict keyed by date.
+
+        It mirrors the structure formerly returned by get_data, it is meant
+        for backward compatibility rather than for hot paths.
+        """
+        return dict(
+            (
+                date.fromordinal(day),
+                {
+                    'start': time_from_seconds(start),
+                    'end': time_from_seconds(end),
+                },
+            )
+            for day, start, end in self.entries(user_id)
+        )
+
+    def entries(self, user_id):
+        """
+        Returns list of (day, start, end) tuples of given user sorted by day.
+        """
+        lower, upper = self.index.get(user_id, (0, 0))
+        return zip(
+            self.days[lower:upper].tolist(),
+            self.starts[lower:upper].tolist(),
+            self.ends[lower:upper].tolist(),
+        )
+
+    def sum_weekdays(self, user_id):
+        """
+        Computes weekday aggregates of given user.
+
+        Returns list of [count, total interval, sum of starts, sum of ends]
+        lists, one for every day in week.
+        """
+        result = [[0, 0, 0, 0] for _ in xrange(7)]
+        for day, start, end in self.entries(user_id):
+            sums = result[weekday(day)]
+            sums[0] += 1
+            sums[1] += end - start
+            sums[2] += start
+            sums[3] += end
+        return result
+
+    def rollup(self, user_ids, first=None, last=None):
+        """
+        Sums weekday aggregates of given users between two day ordinals.
+
+        Users without entries are skipped. Bounds work like in
+        range_weekdays.
+        """
+        result = [[0, 0, 0, 0] for _ in xrange(7)]
+        for user_id in user_ids:
+            if user_id not in self.index:
+                continue
+            for sums, user_sums in zip(
+                    result, self.range_weekdays(user_id, first, last)
+            ):
+                for i, value in enumerate(user_sums):
+                    sums[i] += value
+        return result
+
+    def weekday_prefixes(self):
+        """
+        Returns store-wide per-weekday prefix columns, built on first use.
+
+        Returns (days, starts, ends) columns. Days hold rows of every user
+        regrouped by weekday, so the user's slice of the columns starts
+        with their Monday days, followed by Tuesday ones and so on. Starts
+        and ends are running sums of those rows, restarted at the first
+        row of every user, so slices of users depend only on their own
+        entries and are copied as they are when store is extended.
+        """
+        if self.prefixes is None:
+            prefixes = new_prefixes()
+            for user_id in sorted(self.index):
+                append_prefixes(prefixes, self.entries(user_id))
+            self.prefixes = prefixes
+        return self.prefixes
+
+    def range_weekdays(self, user_id, first=None, last=None):
+        """
+        Returns weekday aggregates of given user between two day ordinals.
+
+        Both bounds are inclusive and optional. Aggregates have the same
+        structure as ones in weekdays, they are computed with binary search
+        over per-weekday prefix columns in O(log n) time.
+        """
+        if first is None and last is None:
+            return self.weekdays[user_id]
+
+        days, starts, ends = self.weekday_prefixes()
+        result = []
+        first_row = lower = self.index[user_id][0]
+        for count, _, _, _ in self.weekdays[user_id]:
+            upper = lower + count
+            left = lower if first is None else bisect_left(
+                days, first, lower, upper
+            )
+            right = upper if last is None else bisect_right(
+                days, last, lower, upper
+            )
+            right = max(left, right)
+            # columns may be NumPy views, sums are converted to plain ints
+            start_sum = end_sum = 0
+            if right > left:
+                start_sum = int(starts[right - 1])
+                end_sum = int(ends[right - 1])
+            if right > left > first_row:
+                start_sum -= int(starts[left - 1])
+                end_sum -= int(ends[left - 1])
+            result.append(
+                [right - left, end_sum - start_sum, start_sum, end_sum]
+            )
+            lower = upper
+        return result
+
+    def group_by_weekday(self, user_id):
+        """
+        Groups presence intervals of given user by weekday.
+        """
+        result = [[], [], [], [], [], [], []]  # one list for every day in week
+        for day, start, end in self.entries(user_id):
+            result[weekday(day)].append(end - start)
+        return result
+
+    def nbytes(self):
+        """
+        Returns amount of memory occupied by column data.
+
+        Prefix columns are counted once they are built.
+        """
+        return sum(
+            column.itemsize * len(column)
+            for column in (
+                (self.user_ids, self.days, self.starts, self.ends) +
+                (self.prefixes or ())
+            )
+        )
@@ -3,25 +3,79 @@
 Presence analyzer unit tests.
 """
 import os.path
+import BaseHTTPServer
+import calendar
+import collections
 import json
+import logging
 import datetime
+import gc
+import shutil
+import stat
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
+import weakref
+import zlib
 
 from flask import url_for
+import werkzeug.test
+import werkzeug.wrappers
 
-from presence_analyzer import main, utils, settings
+from presence_analyzer import (
+    cache,
+    export,
+    fetcher,
+    loader,
+    main,
+    metrics,
+    middleware,
+    models,
+    server,
+    settings,
+    snapshot,
+    store,
+    utils,
+    vectorized,
+)
 from presence_analyzer import views  # pylint: disable=unused-import
 
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_data.csv'
 )
 
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'sample_data.csv'
+)
+
 TEST_DATA_WRONG_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime',
     'data', 'test_data_wrong.csv'
 )
 
 
+class Clock(object):
+    """
+    Replacement of time module with manually advanced time.
+    """
+    now = 1000000.0
+
+    def time(self):
+        """
+        Returns current time.
+        """
+        return self.now
+
+
+def logging_disabled(job):  # pylint: disable=unused-argument
+    """
+    Returns level up to which logging is disabled in current process.
+    """
+    return logging.root.manager.disable
+
+
 # pylint: disable=maybe-no-member, too-many-public-methods
 class PresenceAnalyzerViewsTestCase(unittest.TestCase):
     """
@@ -69,8 +123,20 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertDictEqual(data[0], {
             u'user_id': u'10',
             u'name': u'User 10',
-            u'image_url': u'https://localhost/api/images/users/10'
+            u'image_url': u'https://localhost/api/images/users/10',
+            u'team': u'Backend',
+        })
+
+        etag = resp.headers['ETag']
+        main.app.config.update({
+            'DATA_CSV': os.path.join(settings.APP_DATA, 'missing.csv'),
         })
+        try:
+            resp = self.client.get('/api/v1/users')
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['ETag'], etag)
 
     def test_mean_time_weekday(self):
         """
@@ -122,6 +188,578 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertNotEqual(len(data), 0)
 
+    def test_bulk_views(self):
+        """
+        Test bulk views return results of single user views by user_id.
+        """
+        for name in (
+                'mean_time_weekday', 'presence_weekday', 'presence_start_end'
+        ):
+            resp = self.client.get(
+                '/api/v1/{0}?user_id=10&user_id=0'.format(name)
+            )
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content_type, 'application/json')
+            self.assertIn('ETag', resp.headers)
+            data = json.loads(resp.data)
+            self.assertEqual(sorted(data), ['0', '10'])
+            self.assertIsNone(data['0'])
+            single = json.loads(
+                self.client.get('/api/v1/{0}/10'.format(name)).data
+            )
+            self.assertEqual(data['10'], single)
+
+            resp = self.client.get('/api/v1/{0}'.format(name))
+            self.assertEqual(sorted(json.loads(resp.data)), ['10', '11'])
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday?user_id=11&user_id=10&user_id=11'
+        )
+        self.assertEqual(
+            json.loads(resp.data, object_pairs_hook=collections.OrderedDict)
+            .keys(),
+            ['11', '10'],
+        )
+
+    def test_date_range(self):
+        """
+        Test views limited to from and to dates.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10?from=2013-09-11&to=2013-09-11'
+        )
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data[3], [u'Wed', 24465])
+        self.assertEqual(sum(total for _, total in data[1:]), 24465)
+
+        resp = self.client.get(
+            '/api/v1/presence_start_end?user_id=10&from=2014-01-01'
+        )
+        self.assertEqual(json.loads(resp.data), {'10': []})
+
+        for query in ('from=2013-9-1', 'from=2013-09-12&to=2013-09-11'):
+            resp = self.client.get('/api/v1/mean_time_weekday/10?' + query)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_company_view(self):
+        """
+        Test reports of the whole company.
+        """
+        resp = self.client.get('/api/v1/company/presence_weekday')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        users = [
+            json.loads(
+                self.client.get('/api/v1/presence_weekday/' + user_id).data
+            )
+            for user_id in ('10', '11')
+        ]
+        self.assertEqual(data[1:], [
+            [day, total + other]
+            for (day, total), (_, other) in zip(users[0][1:], users[1][1:])
+        ])
+
+        resp = self.client.get(
+            '/api/v1/company/presence_weekday?from=2013-09-11&to=2013-09-11'
+        )
+        self.assertEqual(json.loads(resp.data)[3], [u'Wed', 24465 + 25321])
+
+        resp = self.client.get('/api/v1/company/unknown')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_quarantine_view(self):
+        """
+        Test listing of rejected lines of CSV file.
+        """
+        resp = self.client.get('/api/v1/admin/quarantine')
+        self.assertEqual(json.loads(resp.data)['total'], 0)
+
+        main.app.config.update({'DATA_CSV': TEST_DATA_WRONG_CSV})
+        resp = self.client.get('/api/v1/admin/quarantine')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['total'], 2)
+        self.assertEqual(data['counts'], {
+            'malformed': 2,
+            'time_out_of_range': 0,
+            'end_before_start': 0,
+            'duplicate': 0,
+        })
+        self.assertEqual(data['lines'][0], {
+            'path': TEST_DATA_WRONG_CSV,
+            'line': 2,
+            'reason': 'malformed',
+            'text': 'a,2013-09-11,09:19:52,16:07:37',
+        })
+
+        resp = self.client.get('/api/v1/admin/quarantine?reason=duplicate')
+        self.assertEqual(json.loads(resp.data)['lines'], [])
+        lines = self.client.get('/metrics').data.splitlines()
+        self.assertIn(
+            'presence_rejected_lines{{path="{0}",reason="malformed"}} 2'
+            .format(TEST_DATA_WRONG_CSV),
+            lines,
+        )
+
+    def test_team_views(self):
+        """
+        Test reports of teams from users XML file.
+        """
+        settings.USERS_XML = os.path.join(settings.APP_DATA, 'test_users.xml')
+
+        resp = self.client.get('/api/v1/teams')
+        self.assertEqual(
+            json.loads(resp.data), {'Backend': [10], 'Frontend': [11]}
+        )
+
+        for report in ('mean_time_weekday', 'presence_start_end'):
+            resp = self.client.get('/api/v1/teams/Backend/' + report)
+            self.assertEqual(resp.status_code, 200)
+            single = self.client.get('/api/v1/{0}/10'.format(report))
+            self.assertEqual(json.loads(resp.data), json.loads(single.data))
+
+        resp = self.client.get(
+            '/api/v1/teams/Backend/presence_weekday?to=2013-09-11'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(sum(total for _, total in data[1:]), 30047 + 24465)
+
+        resp = self.client.get('/api/v1/teams/Nobody/presence_weekday')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_export(self):
+        """
+        Test streamed CSV and NDJSON exports.
+        """
+        resp = self.client.get(
+            '/api/v1/export/presence.csv?user_id=10&from=2013-09-11'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        self.assertTrue(resp.is_streamed)
+        self.assertIn('ETag', resp.headers)
+        self.assertEqual(resp.data, (
+            'user_id,date,start,end\n'
+            '10,2013-09-11,09:19:52,16:07:37\n'
+            '10,2013-09-12,10:48:46,17:23:51\n'
+        ))
+
+        resp = self.client.get(
+            '/api/v1/export/weekdays.ndjson?user_id=10&to=2013-09-10'
+        )
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertEqual(
+            [json.loads(line) for line in resp.data.splitlines()],
+            [{
+                'user_id': 10, 'weekday': 'Tue', 'count': 1,
+                'presence': 30047, 'start': 34745, 'end': 64792,
+            }],
+        )
+
+        resp = self.client.get('/api/v1/export/presence.ndjson')
+        self.assertEqual(
+            len(resp.data.splitlines()), len(utils.get_data())
+        )
+
+        resp = self.client.get('/api/v1/export/presence.xml')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_bulk_views_buffered(self):
+        """
+        Test small bulk documents are cached, large ones streamed.
+        """
+        url = '/api/v1/presence_start_end?user_id=10&user_id=11'
+        utils.RESPONSES.clear()
+        resp = self.client.get(url)
+        self.assertEqual(resp.content_length, len(resp.data))
+        self.assertEqual(utils.RESPONSES.get(resp.get_etag()[0]), resp.data)
+        self.assertEqual(self.client.get(url).data, resp.data)
+
+        utils.RESPONSES.clear()
+        main.app.config['API_BULK_BUFFER_BYTES'] = 10
+        try:
+            streamed = self.client.get(url)
+            self.assertNotIn('Content-Length', streamed.headers)
+            self.assertEqual(streamed.data, resp.data)
+        finally:
+            del main.app.config['API_BULK_BUFFER_BYTES']
+        self.assertEqual(utils.RESPONSES.stats()['entries'], 0)
+
+    def test_bulk_views_wrong(self):
+        """
+        Test bulk views reject malformed user ids.
+        """
+        resp = self.client.get('/api/v1/mean_time_weekday?user_id=john')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_views_not_modified(self):
+        """
+        Test bulk views answer conditional requests with 304.
+        """
+        resp = self.client.get('/api/v1/presence_weekday?user_id=10')
+        etag = resp.headers['ETag']
+        resp = self.client.get(
+            '/api/v1/presence_weekday?user_id=10',
+            headers={'If-None-Match': etag},
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+
+        calls = []
+        range_weekdays = store.PresenceStore.range_weekdays
+        store.PresenceStore.range_weekdays = (
+            lambda *args: calls.append(args) or range_weekdays(*args)
+        )
+        try:
+            resp = self.client.get(
+                '/api/v1/presence_weekday?from=2013-09-11',
+                headers={'If-None-Match': etag},
+            )
+            self.assertEqual(sorted(json.loads(resp.data)), ['10', '11'])
+            self.assertEqual(len(calls), 2)
+            resp = self.client.get(
+                '/api/v1/presence_weekday?from=2013-09-11',
+                headers={'If-None-Match': resp.headers['ETag']},
+            )
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, '')
+        finally:
+            store.PresenceStore.range_weekdays = range_weekdays
+        # aggregates are not computed for 304 response
+        self.assertEqual(len(calls), 2)
+
+
+class PresenceAnalyzerModelsTestCase(unittest.TestCase):
+    """
+    Models tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.users_xml = settings.USERS_XML
+        settings.USERS_XML = os.path.join(self.tmpdir, 'users.xml')
+        shutil.copy(
+            os.path.join(settings.APP_DATA, 'test_users.xml'),
+            settings.USERS_XML,
+        )
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        settings.USERS_XML = self.users_xml
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_data_cache(self):
+        """
+        Test reusing parsed users until XML file changes.
+        """
+        users = models.User.get_data()
+        self.assertEqual(
+            [user['user_id'] for user in users], ['10', '11']
+        )
+        self.assertIs(models.User.get_data(), users)
+
+        with open(settings.USERS_XML) as xml_file:
+            xml = xml_file.read()
+        with open(settings.USERS_XML, 'w') as xml_file:
+            xml_file.write(xml.replace('User 11', 'User Eleven'))
+        self.assertEqual(models.User.get_data()[1], {
+            'user_id': '11',
+            'name': 'User Eleven',
+            'image_url': 'https://localhost/api/images/users/11',
+            'team': 'Frontend',
+        })
+
+
+class UsersXMLHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Stub of server with users XML file.
+    """
+    responses = []
+    requests = []
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Sends the next queued (status, headers, body) response.
+        """
+        self.requests.append(dict(self.headers))
+        status, headers, body = self.responses.pop(0)
+        if status == 'slow':
+            time.sleep(1)
+            status = 200
+        self.send_response(status)
+        for header in headers.iteritems():
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """
+        Silences logging of requests.
+        """
+        pass
+
+
+class PresenceAnalyzerFetcherTestCase(unittest.TestCase):
+    """
+    Users XML file fetcher tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), UsersXMLHandler
+        )
+        # client hangs up on slow responses
+        self.server.handle_error = lambda request, client_address: None
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        UsersXMLHandler.responses = []
+        UsersXMLHandler.requests = []
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'users.xml')
+        self.fetcher = fetcher.UsersFetcher(
+            url='http://127.0.0.1:%d/users.xml' % self.server.server_port,
+            path=self.path,
+            timeout=0.2,
+        )
+        with open(os.path.join(settings.APP_DATA, 'test_users.xml')) as xml:
+            self.xml = xml.read()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_conditional_fetch(self):
+        """
+        Test downloading file only when it changed.
+        """
+        UsersXMLHandler.responses = [
+            (200, {'ETag': '"v1"'}, self.xml),
+            (304, {}, ''),
+        ]
+        self.assertTrue(self.fetcher.fetch())
+        with open(self.path) as xml:
+            self.assertEqual(xml.read(), self.xml)
+        self.assertFalse(self.fetcher.fetch())
+
+        self.assertNotIn('if-none-match', UsersXMLHandler.requests[0])
+        self.assertEqual(UsersXMLHandler.requests[1]['if-none-match'], '"v1"')
+        self.assertNotIn('if-modified-since', UsersXMLHandler.requests[1])
+
+        modified = 'Wed, 11 Sep 2013 10:00:00 GMT'
+        UsersXMLHandler.responses = [
+            (200, {'Last-Modified': modified}, self.xml),
+            (304, {}, ''),
+        ]
+        self.assertTrue(self.fetcher.fetch())
+        self.assertFalse(self.fetcher.fetch())
+        self.assertEqual(
+            UsersXMLHandler.requests[3]['if-modified-since'], modified
+        )
+        self.assertNotIn('if-none-match', UsersXMLHandler.requests[3])
+
+    def test_keep_last_good_copy(self):
+        """
+        Test keeping local file when fetching fails.
+        """
+        with open(self.path, 'w') as xml:
+            xml.write(self.xml)
+        UsersXMLHandler.responses = [
+            (500, {}, 'Internal error'),
+            (200, {}, '<intranet><users>'),
+            ('slow', {}, '<intranet/>'),
+        ]
+        self.assertFalse(self.fetcher.fetch())
+        self.assertFalse(self.fetcher.fetch())
+        self.assertFalse(self.fetcher.fetch())
+        with open(self.path) as xml:
+            self.assertEqual(xml.read(), self.xml)
+        self.assertEqual(os.listdir(self.tmpdir), ['users.xml'])
+
+    def test_file_mode(self):
+        """
+        Test keeping permissions of replaced file.
+        """
+        umask = os.umask(0o022)
+        try:
+            fetcher.write_atomically(self.path, self.xml)
+            self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o644)
+            os.chmod(self.path, 0o640)
+            fetcher.write_atomically(self.path, self.xml)
+            self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o640)
+        finally:
+            os.umask(umask)
+
+    def test_background_fetch(self):
+        """
+        Test serving users without blocking while file is fetched.
+        """
+        UsersXMLHandler.responses = [(200, {}, self.xml)]
+        users_xml, settings.USERS_XML = settings.USERS_XML, self.path
+        fetcher_, models.FETCHER = models.FETCHER, self.fetcher
+        try:
+            self.assertEqual(models.User.get_data(), [])
+            self.fetcher.thread.join(0.5)
+            while not os.path.exists(self.path):
+                time.sleep(0.01)
+            self.assertEqual(len(models.User.get_data()), 2)
+        finally:
+            settings.USERS_XML = users_xml
+            models.FETCHER = fetcher_
+
+
+class PresenceAnalyzerAggregatesTestCase(unittest.TestCase):
+    """
+    Tests of weekday aggregates against computation on raw entries.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': SAMPLE_DATA_CSV})
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+
+    def get_json(self, url):
+        """
+        Returns decoded JSON response of given url.
+        """
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        return json.loads(resp.data)
+
+    def test_views(self):
+        """
+        Test that all users get the same results as from raw entries.
+        """
+        data = utils.get_data()
+        for user_id in data:
+            weekdays = utils.group_by_weekday(data[user_id])
+            self.assertEqual(
+                self.get_json('/api/v1/mean_time_weekday/%d' % user_id),
+                [
+                    [calendar.day_abbr[weekday], utils.mean(intervals)]
+                    for weekday, intervals in enumerate(weekdays)
+                ],
+            )
+            self.assertEqual(
+                self.get_json('/api/v1/presence_weekday/%d' % user_id),
+                [['Weekday', 'Presence (s)']] + [
+                    [calendar.day_abbr[weekday], sum(intervals)]
+                    for weekday, intervals in enumerate(weekdays)
+                ],
+            )
+
+            sums = collections.defaultdict(lambda: [0, 0, 0])
+            for date, item in data[user_id].iteritems():
+                sums[date.weekday()][0] += 1
+                sums[date.weekday()][1] += utils.seconds_since_midnight(
+                    item['start']
+                )
+                sums[date.weekday()][2] += utils.seconds_since_midnight(
+                    item['end']
+                )
+            self.assertEqual(
+                self.get_json('/api/v1/presence_start_end/%d' % user_id),
+                [
+                    [calendar.day_name[i][:3], start / items, end / items]
+                    for i, (items, start, end) in sorted(sums.items())
+                    if i < 5
+                ],
+            )
+
+    def test_merge(self):
+        """
+        Test that merged store gets the same aggregates as built one.
+        """
+        data = utils.get_data()
+        rows = zip(data.user_ids, data.days, data.starts, data.ends)
+        merged = store.PresenceStore.from_rows(rows[::2]).merge(rows[1::2])
+        self.assertEqual(merged.weekdays, data.weekdays)
+        appended = store.PresenceStore.from_rows(
+            row for row in rows if row[1] < 734700
+        ).merge(row for row in rows if row[1] >= 734700)
+        self.assertEqual(appended.weekdays, data.weekdays)
+
+
+class PresenceAnalyzerVectorizedTestCase(unittest.TestCase):
+    """
+    Weekday statistics engines tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        with open(SAMPLE_DATA_CSV) as csvfile:
+            self.data = store.PresenceStore.from_rows(
+                loader.parse_presence_rows(csvfile)
+            )
+
+    def test_python_weekday_stats(self):
+        """
+        Test statistics computed in pure Python.
+        """
+        stats = vectorized.python_weekday_stats(self.data)
+        self.assertItemsEqual(stats.keys(), self.data.keys())
+        weekdays = utils.group_by_weekday(self.data[10])
+        self.assertEqual(
+            [(count, total) for count, total, _, _, _ in stats[10]],
+            [(len(intervals), sum(intervals)) for intervals in weekdays],
+        )
+        self.assertEqual(
+            [interval for _, _, interval, _, _ in stats[10]],
+            [utils.mean(intervals) for intervals in weekdays],
+        )
+
+    @unittest.skipIf(vectorized.numpy is None, 'NumPy is not installed')
+    def test_numpy_weekday_stats(self):
+        """
+        Test that NumPy engine computes the same statistics.
+        """
+        self.assertEqual(
+            vectorized.numpy_weekday_stats(self.data),
+            vectorized.python_weekday_stats(self.data),
+        )
+        self.assertEqual(
+            vectorized.numpy_weekday_stats(store.PresenceStore.from_rows([])),
+            {},
+        )
+
+    def test_fallback(self):
+        """
+        Test falling back to pure Python without NumPy.
+        """
+        numpy, vectorized.numpy = vectorized.numpy, None
+        try:
+            self.assertEqual(
+                vectorized.weekday_stats(self.data),
+                vectorized.python_weekday_stats(self.data),
+            )
+        finally:
+            vectorized.numpy = numpy
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -140,12 +778,113 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         """
         pass
 
+    def test_jsonify_etag(self):
+        """
+        Test answering conditional requests without calling function.
+        """
+        calls = []
+
+        @utils.jsonify
+        def view():
+            """
+            Returns constant data.
+            """
+            calls.append(1)
+            return [1, 2]
+
+        with main.app.test_request_context('/api/v1/test?a=1'):
+            resp = view()
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [1, 2])
+        etag = resp.headers['ETag']
+        self.assertIn('max-age=0', resp.headers['Cache-Control'])
+
+        with main.app.test_request_context(
+                '/api/v1/test?a=1', headers={'If-None-Match': etag}
+        ):
+            resp = view()
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertEqual(calls, [1])
+
+        with main.app.test_request_context(
+                '/api/v1/test?a=2', headers={'If-None-Match': etag}
+        ):
+            resp = view()
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_jsonify_cache(self):
+        """
+        Test reusing serialized responses.
+        """
+        calls = []
+
+        @utils.jsonify
+        def view():
+            """
+            Returns constant data.
+            """
+            calls.append(1)
+            return {'a': 1}
+
+        for _ in xrange(2):
+            with main.app.test_request_context('/api/v1/cached'):
+                self.assertEqual(view().data, '{"a": 1}')
+        self.assertEqual(calls, [1])
+
+    def test_warm_up(self):
+        """
+        Test caching responses of every user after data load.
+        """
+        utils.RESPONSES.clear()
+        utils.warm_up(utils.get_data().version)
+        self.assertEqual(utils.RESPONSES.stats()['entries'], 6)
+
+        client = main.app.test_client()
+        hits = utils.RESPONSES.stats()['hits']
+        client.get('/api/v1/presence_start_end/10')
+        self.assertEqual(utils.RESPONSES.stats()['hits'], hits + 1)
+
+    def test_etag_dataset_version(self):
+        """
+        Test changing of ETags with data.
+        """
+        client = main.app.test_client()
+        users_xml = settings.USERS_XML
+        settings.USERS_XML = os.path.join(settings.APP_DATA, 'test_users.xml')
+        try:
+            etag = client.get('/api/v1/presence_weekday/11').headers['ETag']
+            # users XML file is replaced, presence data is not
+            settings.USERS_XML = TEST_DATA_CSV
+            self.assertEqual(
+                client.get(
+                    '/api/v1/presence_weekday/11',
+                    headers={'If-None-Match': etag},
+                ).status_code,
+                304,
+            )
+        finally:
+            settings.USERS_XML = users_xml
+
+        main.app.config.update({'DATA_CSV': TEST_DATA_WRONG_CSV})
+        try:
+            resp = client.get(
+                '/api/v1/presence_weekday/11',
+                headers={'If-None-Match': etag},
+            )
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
     def test_get_data(self):
         """
         Test parsing of CSV file.
         """
         data = utils.get_data()
-        self.assertIsInstance(data, dict)
+        self.assertIsInstance(data, store.PresenceStore)
         self.assertItemsEqual(data.keys(), [10, 11])
         sample_date = datetime.date(2013, 9, 10)
         self.assertIn(sample_date, data[10])
@@ -163,6 +902,1313 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         data = utils.get_data()
         self.assertIsNotNone(data)
 
+    def test_get_data_user_id_range(self):
+        """
+        Test skipping user ids that do not fit in store columns.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'data.csv')
+            with open(path, 'w') as csvfile:
+                csvfile.write(
+                    '99999999999,2013-09-10,09:00:00,17:00:00\n'
+                    '10,2013-09-10,09:00:00,17:00:00\n'
+                )
+            main.app.config.update({'DATA_CSV': path})
+            self.assertItemsEqual(utils.get_data().keys(), [10])
+            resp = main.app.test_client().get('/api/v1/presence_weekday/10')
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+            shutil.rmtree(tmpdir)
+
+    def test_get_data_source(self):
+        """
+        Test reloading of data when DATA_CSV or its file changes.
+        """
+        tmpdir = tempfile.mkdtemp()
+        clock = Clock()
+        time_module, cache.time = cache.time, clock
+        try:
+            path = os.path.join(tmpdir, 'data.csv')
+            shutil.copy(TEST_DATA_CSV, path)
+            main.app.config.update({'DATA_CSV': path})
+            data = utils.get_data()
+            self.assertIs(utils.get_data(), data)
+
+            # files are checked for changes at most once per second
+            with open(path, 'a') as csvfile:
+                csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+            self.assertIs(utils.get_data(), data)
+            clock.now += 1
+            self.assertItemsEqual(utils.get_data().keys(), [10, 11, 12])
+
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+            self.assertItemsEqual(utils.get_data().keys(), [10, 11])
+            # nothing refers to data of previous DATA_CSV
+            self.assertEqual(loader.LOADERS.keys(), [TEST_DATA_CSV])
+            self.assertEqual(utils.get_data.cache.stats()['entries'], 1)
+            data = weakref.ref(data)
+            gc.collect()
+            self.assertIsNone(data())
+        finally:
+            cache.time = time_module
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+            shutil.rmtree(tmpdir)
+
+
+class PresenceAnalyzerLoaderTestCase(unittest.TestCase):
+    """
+    CSV loading tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        with open(TEST_DATA_CSV) as csvfile:
+            self.lines = csvfile.read().splitlines(True)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, lines, mode='w'):
+        """
+        Writes given lines into test CSV file.
+        """
+        with open(self.path, mode) as csvfile:
+            csvfile.writelines(lines)
+
+    def test_parse_presence_rows(self):
+        """
+        Test skipping of malformed lines by CSV parser.
+        """
+        with open(TEST_DATA_WRONG_CSV) as csvfile:
+            rows = list(loader.parse_presence_rows(csvfile))
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(
+            rows[0],
+            (10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792),
+        )
+        self.assertEqual([row[0] for row in rows].count(10), 1)
+
+    def test_validation(self):
+        """
+        Test rejecting invalid lines with their numbers and reasons.
+        """
+        rejected = []
+        rows = list(loader.parse_presence_rows([
+            '10,2013-09-10,09:00:00,17:00:00\n',
+            '\n',
+            '10,2013-09-11,09:00:00\n',
+            '10,2013-09-12,17:00:00,09:00:00\n',
+            '10,2013-09-13,09:00:00,24:00:00\n',
+            '10,2013-09-10,10:00:00,18:00:00\r\n',
+            'a,2013-09-14,09:00:00,17:00:00\n',
+            '99999999999,2013-09-10,09:00:00,17:00:00\n',
+            ' -5,2013-09-10,09:00:00,17:00:00\n',
+        ], 10, rejected))
+        self.assertEqual(rows, [
+            (10, datetime.date(2013, 9, 10).toordinal(), 32400, 61200),
+            (10, datetime.date(2013, 9, 10).toordinal(), 36000, 64800),
+        ])
+        self.assertEqual(rejected, [
+            (13, 'malformed', '10,2013-09-11,09:00:00'),
+            (14, 'end_before_start', '10,2013-09-12,17:00:00,09:00:00'),
+            (15, 'time_out_of_range', '10,2013-09-13,09:00:00,24:00:00'),
+            (11, 'duplicate', '10,2013-09-10,09:00:00,17:00:00'),
+            (17, 'malformed', 'a,2013-09-14,09:00:00,17:00:00'),
+            (18, 'malformed', '99999999999,2013-09-10,09:00:00,17:00:00'),
+            (19, 'malformed', ' -5,2013-09-10,09:00:00,17:00:00'),
+        ])
+        self.assertEqual(
+            list(store.PresenceStore.from_rows(rows).entries(10)),
+            [(datetime.date(2013, 9, 10).toordinal(), 36000, 64800)],
+        )
+
+    def test_wrong_lines_skipped(self):
+        """
+        Test invalid lines add no entries, not even with values of others.
+        """
+        presence_loader = loader.PresenceLoader(TEST_DATA_WRONG_CSV)
+        data = presence_loader.load()
+        self.assertEqual(
+            list(data.entries(10)),
+            [(datetime.date(2013, 9, 10).toordinal(), 34745, 64792)],
+        )
+        self.assertEqual(
+            [record[1:3] for record in presence_loader.quarantine()],
+            [(2, 'malformed'), (3, 'malformed')],
+        )
+
+    def test_parse_time(self):
+        """
+        Test conversion of HH:MM:SS strings.
+        """
+        self.assertEqual(loader.parse_time('00:00:00'), 0)
+        self.assertEqual(loader.parse_time('23:59:59'), 86399)
+        for text in ['24:00:00', '12:60:00', '1:00:00', '-1:00:00', 'ab']:
+            self.assertRaises(ValueError, loader.parse_time, text)
+
+    def test_parse_date(self):
+        """
+        Test conversion of YYYY-MM-DD strings.
+        """
+        self.assertEqual(
+            loader.parse_date('2013-09-10'),
+            datetime.date(2013, 9, 10).toordinal(),
+        )
+        for text in ['2013-02-30', '2013/09/10', '13-09-10']:
+            self.assertRaises(ValueError, loader.parse_date, text)
+
+    def test_load_appended(self):
+        """
+        Test reading of lines appended to already loaded file.
+        """
+        self.write(self.lines[:5] + ['11,2013-09-1'])
+        presence_loader = loader.PresenceLoader(self.path)
+        data = presence_loader.load()
+        self.assertEqual(len(data), 5)
+        self.assertIs(presence_loader.load(), data)
+        self.assertEqual(presence_loader.line, 5)
+        self.assertEqual(presence_loader.quarantine(), [])
+
+        self.write(['3,13:16:56,15:04:02\n'] + self.lines[5:8], 'a')
+        data = presence_loader.load()
+        self.assertEqual(presence_loader.line, 9)
+        self.assertEqual(len(data), 9)
+        self.assertEqual(presence_loader.reloads, {'full': 1, 'append': 1})
+        self.assertEqual(
+            list(data.entries(11))[-1],
+            (datetime.date(2013, 9, 13).toordinal(), 47816, 54242),
+        )
+
+        self.write(['10,2013-09-10,09:00:00'], 'a')
+        presence_loader.load()
+        self.assertEqual(presence_loader.quarantine(), [])
+        self.write([',08:00:00\n'], 'a')
+        self.assertEqual(len(presence_loader.load()), 9)
+        self.assertEqual(presence_loader.quarantine(), [(
+            self.path, 10, 'end_before_start',
+            '10,2013-09-10,09:00:00,08:00:00',
+        )])
+
+    def test_load_replaced(self):
+        """
+        Test full reload of rewritten file.
+        """
+        self.write(self.lines)
+        presence_loader = loader.PresenceLoader(self.path)
+        self.assertEqual(len(presence_loader.load()), 9)
+
+        self.write(self.lines[:2])
+        self.assertEqual(len(presence_loader.load()), 2)
+
+        self.write(self.lines[3:])
+        self.assertEqual(sorted(presence_loader.load()), [11])
+        self.assertEqual(presence_loader.reloads, {'full': 3})
+        self.assertGreater(presence_loader.duration, 0)
+
+
+class PresenceAnalyzerParallelLoaderTestCase(unittest.TestCase):
+    """
+    Chunked parallel parsing tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        with open(SAMPLE_DATA_CSV) as csvfile:
+            lines = csvfile.read().splitlines(True)
+        # malformed lines, duplicates and incomplete last line
+        lines[100:100] = ['user_id,date,start,end\n', '10,2011-06-01,x,y\n']
+        lines.extend(lines[:50])
+        lines.append('10,2011-06-01,01:00:00,02:00:00')
+        with open(self.path, 'w') as csvfile:
+            csvfile.writelines(lines)
+        self.chunk_size = loader.PresenceLoader.chunk_size
+        loader.PresenceLoader.chunk_size = 1024
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        loader.PresenceLoader.chunk_size = self.chunk_size
+        shutil.rmtree(self.tmpdir)
+
+    def test_workers_do_not_log(self):
+        """
+        Test logging is disabled in worker processes only.
+        """
+        self.assertEqual(
+            loader.map_processes(logging_disabled, [1, 2], 2),
+            [logging.CRITICAL] * 2,
+        )
+        self.assertEqual(
+            loader.map_processes(logging_disabled, [1], 2), [0]
+        )
+
+    def test_chunk_ranges(self):
+        """
+        Test ranges cover the whole file and are aligned to lines.
+        """
+        size = os.path.getsize(self.path)
+        ranges = loader.chunk_ranges(self.path, size, 7)
+        self.assertEqual(len(ranges), 7)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], size)
+        with open(self.path, 'rb') as csvfile:
+            content = csvfile.read()
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(content[end - 1], '\n')
+        self.assertEqual(len(loader.chunk_ranges(self.path, 10, 7)), 1)
+
+    def test_parallel_load(self):
+        """
+        Test parallel load is identical to sequential one.
+        """
+        sequential = loader.PresenceLoader(self.path)
+        expected = sequential.load(processes=1)
+        parallel = loader.PresenceLoader(self.path)
+        data = parallel.load(processes=3)
+        for column in ['user_ids', 'days', 'starts', 'ends']:
+            self.assertEqual(getattr(data, column), getattr(expected, column))
+        self.assertEqual(data.index, expected.index)
+        self.assertEqual(data.weekdays, expected.weekdays)
+        self.assertEqual(data.totals, expected.totals)
+        self.assertEqual(
+            (parallel.offset, parallel.line),
+            (sequential.offset, sequential.line),
+        )
+        malformed = [
+            record for record in sequential.quarantine()
+            if record[2] == 'malformed'
+        ]
+        self.assertEqual([record[1] for record in malformed], [101, 102])
+        # duplicates in different chunks are rejected as well
+        self.assertEqual(len(sequential.quarantine()), 53)
+        self.assertEqual(parallel.quarantine(), sequential.quarantine())
+
+        # incomplete last line was parsed, so the whole file is read again
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('3:00\n11,2011-06-01,09:00:00,17:00:00\n')
+        self.assertEqual(
+            list(parallel.load(processes=3).entries(10)),
+            list(sequential.load(processes=1).entries(10)),
+        )
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('10,2011-06-02,09:00:00,17:00:00\n')
+        self.assertEqual(
+            list(parallel.load(processes=3).entries(10)),
+            list(sequential.load(processes=1).entries(10)),
+        )
+        self.assertEqual(parallel.reloads, {'full': 2, 'append': 1})
+        # replaced entries of appended lines are rejected like in full load
+        self.assertEqual(parallel.quarantine(), sequential.quarantine())
+        full = loader.PresenceLoader(self.path)
+        full.load(processes=1)
+        self.assertEqual(list(full.store.entries(10)), list(
+            parallel.store.entries(10)
+        ))
+        self.assertEqual(parallel.quarantine(), full.quarantine())
+        self.assertEqual(len(full.quarantine()), 55)
+
+
+class PresenceAnalyzerShardedLoaderTestCase(unittest.TestCase):
+    """
+    Loading of many CSV files tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        with open(SAMPLE_DATA_CSV) as csvfile:
+            lines = csvfile.read().splitlines(True)
+        third = len(lines) // 3
+        for i, part in enumerate([
+                lines[:third], lines[third:2 * third], lines[2 * third:],
+        ]):
+            self.write('2013-{0:02d}.csv'.format(i + 1), part)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, lines):
+        """
+        Writes given lines into CSV file in test directory.
+        """
+        with open(os.path.join(self.tmpdir, name), 'w') as csvfile:
+            csvfile.writelines(lines)
+
+    def test_load(self):
+        """
+        Test merged files are the same as one file.
+        """
+        expected = loader.PresenceLoader(SAMPLE_DATA_CSV).load()
+        for path, processes in [
+                (self.tmpdir, 2),
+                (os.path.join(self.tmpdir, '2013-*.csv'), 1),
+        ]:
+            sharded = loader.ShardedLoader(path)
+            data = sharded.load(processes=processes)
+            for column in ['user_ids', 'days', 'starts', 'ends']:
+                self.assertEqual(
+                    getattr(data, column), getattr(expected, column)
+                )
+            self.assertEqual(data.weekdays, expected.weekdays)
+            self.assertEqual(data.totals, expected.totals)
+            self.assertIs(sharded.load(), data)
+
+        self.assertIsInstance(
+            loader.loader_for(self.tmpdir), loader.ShardedLoader
+        )
+        self.assertIsInstance(
+            loader.loader_for(SAMPLE_DATA_CSV), loader.PresenceLoader
+        )
+
+    def test_duplicates(self):
+        """
+        Test entries of later files take precedence.
+        """
+        sharded = loader.ShardedLoader(self.tmpdir)
+        data = sharded.load(snapshot=True, processes=1)
+        first = os.path.join(self.tmpdir, '2013-01.csv')
+        stat = os.stat(first)
+        self.assertEqual(
+            sharded.shards[first],
+            ((stat.st_ino, stat.st_size, stat.st_mtime), []),
+        )
+
+        self.write('2013-00.csv', ['10,2011-06-01,01:00:00,02:00:00\n'])
+        self.write('2013-04.csv', ['10,2011-06-02,03:00:00,04:00:00\n'])
+        parsed = []
+        read_presence_file = loader.read_presence_file
+
+        def record(path):
+            """
+            Records paths of parsed files.
+            """
+            parsed.append(os.path.basename(path))
+            return read_presence_file(path)
+
+        loader.read_presence_file = record
+        try:
+            data = sharded.load(snapshot=True, processes=1)
+        finally:
+            loader.read_presence_file = read_presence_file
+        self.assertEqual(parsed, ['2013-00.csv', '2013-04.csv'])
+        entries = dict(
+            (day, (start, end)) for day, start, end in data.entries(10)
+        )
+        self.assertEqual(
+            entries[datetime.date(2011, 6, 1).toordinal()], (31123, 62342)
+        )
+        self.assertEqual(
+            entries[datetime.date(2011, 6, 2).toordinal()], (10800, 14400)
+        )
+        self.assertEqual(data.weekdays[10], data.sum_weekdays(10))
+        self.assertEqual(data.totals, data.rollup(data.index))
+        self.assertEqual(sharded.quarantine(), [
+            (
+                os.path.join(self.tmpdir, '2013-00.csv'), 1, 'duplicate',
+                '10,2011-06-01,01:00:00,02:00:00',
+            ),
+            (
+                os.path.join(self.tmpdir, '2013-01.csv'), 2, 'duplicate',
+                '10,2011-06-02,08:31:51,16:13:47',
+            ),
+        ])
+
+    def test_snapshots(self):
+        """
+        Test files are read from snapshots written after parsing them.
+        """
+        self.write('2013-04.csv', ['10,2011-06-02,25:00:00,04:00:00\n'])
+        sharded = loader.ShardedLoader(self.tmpdir)
+        data = sharded.load(snapshot=True, processes=2)
+        paths = loader.shard_paths(self.tmpdir)
+        for path in paths:
+            self.assertTrue(os.path.exists(snapshot.snapshot_path(path)))
+
+        read_presence_file = loader.read_presence_file
+        loader.read_presence_file = None
+        try:
+            cached = loader.ShardedLoader(self.tmpdir)
+            loaded = cached.load(snapshot=True, processes=2)
+        finally:
+            loader.read_presence_file = read_presence_file
+        self.assertEqual(loaded.days, data.days)
+        self.assertEqual(cached.quarantine(), sharded.quarantine())
+        self.assertEqual(cached.quarantine()[0][:3], (
+            paths[-1], 1, 'time_out_of_range',
+        ))
+
+    def test_snapshots_glob(self):
+        """
+        Test snapshots are not loaded as files matching pattern.
+        """
+        path = os.path.join(self.tmpdir, '*')
+        sharded = loader.ShardedLoader(path)
+        data = sharded.load(snapshot=True, processes=1)
+        stamp = loader.source_stamp(path)
+        self.assertEqual(len(stamp), 3)
+        self.write('2013-01.csv.snapshotx1_Y2z', [])
+        with snapshot.snapshot_lock(os.path.join(self.tmpdir, '2013-02.csv')):
+            self.assertEqual(loader.source_stamp(path), stamp)
+
+        self.assertIs(sharded.load(snapshot=True, processes=1), data)
+        cached = loader.ShardedLoader(path)
+        self.assertEqual(
+            cached.load(snapshot=True, processes=1).days, data.days
+        )
+        self.assertEqual(cached.quarantine(), [])
+        self.assertEqual(len(os.listdir(self.tmpdir)), 8)
+
+    def test_source_stamp(self):
+        """
+        Test state of CSV files changes with any of them.
+        """
+        stamp = loader.source_stamp(self.tmpdir)
+        self.assertEqual(len(stamp), 3)
+        self.assertEqual(
+            loader.source_stamp(os.path.join(self.tmpdir, '*.csv')), stamp
+        )
+        self.assertEqual(
+            loader.source_stamp(SAMPLE_DATA_CSV)[0][0], SAMPLE_DATA_CSV
+        )
+
+        self.write('2013-04.csv', ['10,2011-06-02,03:00:00,04:00:00\n'])
+        self.assertEqual(len(loader.source_stamp(self.tmpdir)), 4)
+        self.assertIsNone(
+            loader.source_stamp(os.path.join(self.tmpdir, 'missing.csv'))
+        )
+
+
+class PresenceAnalyzerSnapshotTestCase(unittest.TestCase):
+    """
+    Binary snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(SAMPLE_DATA_CSV, self.path)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_load_snapshot(self):
+        """
+        Test loading data from snapshot instead of CSV file.
+        """
+        data = loader.PresenceLoader(self.path).load(snapshot=True)
+        self.assertTrue(os.path.exists(snapshot.snapshot_path(self.path)))
+
+        read_presence_file = loader.read_presence_file
+        loader.read_presence_file = None
+        try:
+            presence_loader = loader.PresenceLoader(self.path)
+            loaded = presence_loader.load(snapshot=True)
+        finally:
+            loader.read_presence_file = read_presence_file
+
+        for column in ['user_ids', 'days', 'starts', 'ends']:
+            self.assertEqual(getattr(loaded, column), getattr(data, column))
+        self.assertEqual(loaded.index, data.index)
+        self.assertEqual(loaded.weekdays, data.weekdays)
+        self.assertIsNone(loaded.prefixes)
+        self.assertEqual(presence_loader.offset, os.path.getsize(self.path))
+
+        data.weekday_prefixes()
+        snapshot.write_snapshot(
+            self.path, data, os.stat(self.path), presence_loader.offset,
+            presence_loader.line,
+        )
+        loaded = snapshot.read_snapshot(self.path, os.stat(self.path))[0]
+        self.assertEqual(loaded.prefixes, data.prefixes)
+        self.assertEqual(
+            loaded.range_weekdays(10, 735100),
+            data.range_weekdays(10, 735100),
+        )
+
+    def test_snapshot_rejected(self):
+        """
+        Test keeping rejected lines in snapshot.
+        """
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('10,2013-09-13,13:16:56,25:04:02\n')
+        presence_loader = loader.PresenceLoader(self.path)
+        presence_loader.load(snapshot=True)
+        rejected = presence_loader.rejected
+        self.assertEqual(rejected[0][1:], (
+            'time_out_of_range', '10,2013-09-13,13:16:56,25:04:02'
+        ))
+        self.assertEqual(
+            snapshot.read_snapshot(self.path, os.stat(self.path))[3],
+            rejected,
+        )
+
+    def test_invalidation(self):
+        """
+        Test ignoring snapshot of changed CSV file.
+        """
+        loader.PresenceLoader(self.path).load(snapshot=True)
+        self.assertIsNotNone(
+            snapshot.read_snapshot(self.path, os.stat(self.path))
+        )
+
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('10,2013-09-13,13:16:56,15:04:02\n')
+        self.assertIsNone(
+            snapshot.read_snapshot(self.path, os.stat(self.path))
+        )
+        data = loader.PresenceLoader(self.path).load(snapshot=True)
+        self.assertIn(
+            (datetime.date(2013, 9, 13).toordinal(), 47816, 54242),
+            list(data.entries(10)),
+        )
+
+        with open(snapshot.snapshot_path(self.path), 'r+') as snapshot_file:
+            snapshot_file.truncate(100)
+        self.assertIsNone(
+            snapshot.read_snapshot(self.path, os.stat(self.path))
+        )
+
+
+@unittest.skipIf(snapshot.numpy is None, 'NumPy is not installed')
+class PresenceAnalyzerSharedTestCase(unittest.TestCase):
+    """
+    Tests of presence data shared between processes.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        main.app.config.update({'DATA_CSV': self.path, 'DATA_SHARED': True})
+        utils.get_data.cache.clear()
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_SHARED': False,
+        })
+        utils.get_data.cache.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def assert_mapped(self, data):
+        """
+        Checks that store and prefix columns are views of mapped snapshot.
+        """
+        for column in [
+                data.user_ids, data.days, data.starts, data.ends,
+        ] + list(data.prefixes):
+            self.assertIsInstance(column, snapshot.numpy.ndarray)
+            self.assertFalse(column.flags.owndata)
+            self.assertFalse(column.flags.writeable)
+
+    def test_shared_load(self):
+        """
+        Test mapping of shared store after parsing and appending.
+        """
+        data = loader.PresenceLoader(self.path).load(shared=True)
+        self.assert_mapped(data)
+        self.assertEqual(
+            data[10][datetime.date(2013, 9, 10)]['start'],
+            datetime.time(9, 39, 5),
+        )
+
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('\n10,2013-09-13,13:16:56,15:04:02\n')
+        presence_loader = loader.PresenceLoader(self.path)
+        data = presence_loader.load(shared=True)
+        self.assert_mapped(data)
+        self.assertEqual(len(data), 10)
+        self.assertEqual(presence_loader.line, 10)
+
+    def test_views(self):
+        """
+        Test API views reading shared store.
+        """
+        self.assert_mapped(utils.get_data())
+        resp = self.client.get('/api/v1/presence_start_end/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [
+            ['Tue', 34745, 64792],
+            ['Wed', 33592, 58057],
+            ['Thu', 38926, 62631],
+        ])
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10?from=2013-09-11&to=2013-09-11'
+        )
+        self.assertEqual(json.loads(resp.data)[3], [u'Wed', 24465])
+
+
+class PresenceAnalyzerStoreTestCase(unittest.TestCase):
+    """
+    Columnar presence store tests.
+    """
+
+    def test_from_rows(self):
+        """
+        Test sorting, deduplication and offset index of built store.
+        """
+        data = store.PresenceStore.from_rows([
+            (11, 735000, 100, 200),
+            (10, 735001, 300, 400),
+            (10, 735000, 500, 600),
+            (10, 735001, 700, 800),
+        ])
+        self.assertEqual(len(data), 3)
+        self.assertEqual(list(data.user_ids), [10, 10, 11])
+        self.assertEqual(data.index, {10: (0, 2), 11: (2, 3)})
+        self.assertEqual(
+            list(data.entries(10)),
+            [(735000, 500, 600), (735001, 700, 800)],
+        )
+        self.assertEqual(list(data.entries(12)), [])
+        self.assertEqual(data.nbytes(), 3 * 4 * data.days.itemsize)
+
+    def test_from_sorted_rows(self):
+        """
+        Test building store of rows already in order, with duplicates.
+        """
+        rows = [
+            (10, 735000, 100, 200),
+            (10, 735001, 300, 400),
+            (10, 735001, 500, 600),
+            (11, 735000, 700, 800),
+        ]
+        data = store.PresenceStore.from_rows(iter(rows))
+        self.assertEqual(
+            list(data.entries(10)),
+            [(735000, 100, 200), (735001, 500, 600)],
+        )
+        self.assertEqual(
+            data.user_ids, store.PresenceStore.from_rows(rows[::-1]).user_ids
+        )
+        self.assertEqual(data.index, {10: (0, 2), 11: (2, 3)})
+
+    def test_merge(self):
+        """
+        Test merging of new rows into store.
+        """
+        data = store.PresenceStore.from_rows([
+            (10, 735000, 100, 200),
+            (10, 735002, 100, 200),
+            (11, 735000, 100, 200),
+        ])
+        self.assertIs(data.merge([]), data)
+        merged = data.merge([
+            (10, 735001, 300, 400),
+            (10, 735002, 500, 600),
+            (12, 735003, 700, 800),
+        ])
+        self.assertEqual(len(data), 3)
+        self.assertEqual(
+            list(merged.entries(10)),
+            [(735000, 100, 200), (735001, 300, 400), (735002, 500, 600)],
+        )
+        self.assertEqual(list(merged.entries(11)), [(735000, 100, 200)])
+        self.assertEqual(merged.index[12], (4, 5))
+        self.assertEqual(merged.totals, merged.rollup(merged.index))
+
+    def test_getitem(self):
+        """
+        Test dict-like access to presence entries of user.
+        """
+        day = datetime.date(2013, 9, 10)
+        data = store.PresenceStore.from_rows([
+            (10, day.toordinal(), 34745, 64792),
+        ])
+        self.assertIn(10, data)
+        self.assertNotIn(11, data)
+        self.assertEqual(data[10], {
+            day: {
+                'start': datetime.time(9, 39, 5),
+                'end': datetime.time(17, 59, 52),
+            },
+        })
+        self.assertEqual(data.group_by_weekday(10)[day.weekday()], [30047])
+
+    def test_range_weekdays(self):
+        """
+        Test weekday aggregates limited to date range.
+        """
+        rows = [
+            (10, day, day % 600, day % 600 + day % 7 * 100)
+            for day in xrange(735000, 735100, 2)
+        ]
+        data = store.PresenceStore.from_rows(
+            [(9, 735000, 1, 2)] + rows + [(11, 735000, 1, 2)]
+        )
+        self.assertIs(data.range_weekdays(10), data.weekdays[10])
+        for first, last in [
+                (735010, 735030), (735011, 735011), (None, 735020),
+                (735090, None), (734000, 734001), (736000, 737000),
+        ]:
+            expected = store.PresenceStore.from_rows(
+                row for row in rows
+                if (first is None or row[1] >= first) and
+                (last is None or row[1] <= last)
+            ).weekdays.get(10, [[0, 0, 0, 0]] * 7)
+            self.assertEqual(
+                data.range_weekdays(10, first, last), expected
+            )
+        days, starts, ends = data.prefixes
+        self.assertEqual(len(days), len(data))
+        self.assertEqual(len(starts), len(data))
+        self.assertEqual(ends[-2], sum(data.ends) - 4)
+        self.assertEqual(data.range_weekdays(11, 735000, 735000)[6][0], 1)
+
+    def test_extend_prefixes(self):
+        """
+        Test prefix columns are carried over to extended stores.
+        """
+        rows = [
+            (user_id, day, day % 600, day % 600 + 100)
+            for user_id in (10, 11, 12) for day in xrange(735000, 735030, 3)
+        ]
+        data = store.PresenceStore.from_rows(rows)
+        self.assertIsNone(data.merge([(11, 735100, 1, 2)]).prefixes)
+        self.assertIsNone(data.prefixes)
+
+        data.weekday_prefixes()
+        for update in [
+                [(11, 735100, 1, 2)],
+                [(11, 735003, 5, 6), (13, 735000, 1, 2)],
+        ]:
+            expected = store.PresenceStore.from_rows(rows + update)
+            expected.weekday_prefixes()
+            self.assertEqual(data.merge(update).prefixes, expected.prefixes)
+
+            other = store.PresenceStore.from_rows(update)
+            other.weekday_prefixes()
+            combined = store.PresenceStore.combine([data, other])
+            self.assertEqual(combined.prefixes, expected.prefixes)
+        self.assertIsNone(store.PresenceStore.combine([
+            data, store.PresenceStore.from_rows([(10, 735100, 1, 2)]),
+        ]).prefixes)
+
+
+class PresenceAnalyzerExportTestCase(unittest.TestCase):
+    """
+    Export tests.
+    """
+
+    def test_chunks(self):
+        """
+        Test records are yielded in chunks of limited size.
+        """
+        records = [(i, 'x') for i in xrange(5)]
+        chunks = list(export.csv_chunks(('a', 'b'), iter(records), 2))
+        self.assertEqual(chunks, [
+            'a,b\n', '0,x\n1,x\n', '2,x\n3,x\n', '4,x\n',
+        ])
+        chunks = list(export.ndjson_chunks(('a', 'b'), iter(records), 5))
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(chunks[0].splitlines()[0], '{"a": 0, "b": "x"}')
+        self.assertEqual(list(export.ndjson_chunks(('a', ), iter([]))), [])
+
+    def test_presence_records(self):
+        """
+        Test presence entries are filtered by user and date range.
+        """
+        data = store.PresenceStore.from_rows(
+            (user_id, day, 3600, 7200)
+            for user_id in (10, 11) for day in xrange(735000, 735010)
+        )
+        records = list(export.presence_records(data, [11, 12], 735008))
+        self.assertEqual(records, [
+            (11, '2013-05-20', '01:00:00', '02:00:00'),
+            (11, '2013-05-21', '01:00:00', '02:00:00'),
+        ])
+        self.assertEqual(
+            len(list(export.presence_records(data, [10], None, 735004))), 5
+        )
+
+
+@unittest.skipIf(server.WSGIServer is None, 'gevent is not installed')
+class PresenceAnalyzerServerTestCase(unittest.TestCase):
+    """
+    Asynchronous server tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.stale = utils.get_data.cache.stale
+        self.tmpdir = tempfile.mkdtemp()
+        self.stop = None
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        if self.stop is not None:
+            self.stop.set()
+        utils.get_data.cache.stale = self.stale
+        utils.get_data.cache.background = True
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        shutil.rmtree(self.tmpdir)
+
+    def test_serve(self):
+        """
+        Test serving API while requests are made from another thread.
+        """
+        import gevent
+
+        http = server.make_server(main.app, '127.0.0.1', 0, connections=4)
+        http.start()
+        url = 'http://127.0.0.1:{0}/api/v1/presence_weekday/10'.format(
+            http.server_port
+        )
+        responses = []
+        client = threading.Thread(
+            target=lambda: responses.append(urllib2.urlopen(url).read())
+        )
+        try:
+            client.start()
+            while client.is_alive():
+                gevent.sleep(0.01)
+        finally:
+            http.stop()
+        self.assertEqual(
+            json.loads(responses[0]),
+            json.loads(main.app.test_client().get(url).data),
+        )
+
+    def test_prepare_data(self):
+        """
+        Test loading data with reloads in background thread.
+        """
+        path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path})
+        self.stop = server.prepare_data(interval=0.01)
+        self.assertIsNotNone(utils.get_data.cache.get(
+            ((), (), path), stamp=loader.source_stamp(path),
+        ))
+        data = utils.get_data()
+
+        threads = []
+        load = loader.PresenceLoader.load
+        loader.PresenceLoader.load = (
+            lambda *args, **kwargs:
+            threads.append(threading.current_thread()) or load(*args, **kwargs)
+        )
+        try:
+            with open(path, 'a') as csvfile:
+                csvfile.write('\n12,2013-09-10,09:00:00,17:00:00\n')
+            utils.STAMPS.clear()
+            deadline = time.time() + 5
+            while utils.get_data() is data and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            loader.PresenceLoader.load = load
+        self.assertItemsEqual(utils.get_data().keys(), [10, 11, 12])
+        # data is never reloaded during request
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual(utils.get_data.cache.refreshing, set())
+
+
+class PresenceAnalyzerMetricsTestCase(unittest.TestCase):
+    """
+    Metrics tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.client = main.app.test_client()
+
+    def test_histogram(self):
+        """
+        Test rendering of histogram with cumulative buckets.
+        """
+        histogram = metrics.Histogram(
+            'test_seconds', 'Test.', labels=('name', ), buckets=(0.1, 1.0)
+        )
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, 'a"b')
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{name="a\\"b",le="0.1"} 2',
+            'test_seconds_bucket{name="a\\"b",le="1.0"} 3',
+            'test_seconds_bucket{name="a\\"b",le="+Inf"} 4',
+            'test_seconds_sum{name="a\\"b"} 2.65',
+            'test_seconds_count{name="a\\"b"} 4',
+        ])
+
+    def test_metrics_view(self):
+        """
+        Test metrics endpoint exposes requests, caches and dataset.
+        """
+        self.client.get('/api/v1/presence_weekday/10')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/plain')
+        lines = resp.data.splitlines()
+        self.assertIn(
+            'presence_dataset_rows{{path="{0}"}} 9'.format(TEST_DATA_CSV),
+            lines,
+        )
+        for prefix in (
+                'presence_cache_misses_total{cache="get_data"}',
+                'presence_request_duration_seconds_count{'
+                'endpoint="presence_weekday_view",status="200"}',
+                'presence_call_duration_seconds_count{function="get_data"}',
+                'presence_reload_duration_seconds{',
+                'presence_reloads_total{',
+        ):
+            self.assertTrue(
+                any(line.startswith(prefix) for line in lines), prefix
+            )
+
+
+class PresenceAnalyzerCacheTestCase(unittest.TestCase):
+    """
+    Cache tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.clock = Clock()
+        self.time, cache.time = cache.time, self.clock
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        cache.time = self.time
+
+    def test_timeout(self):
+        """
+        Test expiration of entries older than a day.
+        """
+        values = cache.Cache(timeout=600)
+        values.set('key', 1)
+        self.assertEqual(values.get('key'), 1)
+        self.clock.now += 599
+        self.assertEqual(values.get('key'), 1)
+        self.clock.now += 86400
+        self.assertIsNone(values.get('key'))
+        self.assertEqual(values.get_or_compute('key', lambda: 2), 2)
+        self.assertEqual(values.stats(), {
+            'entries': 1, 'bytes': 0, 'hits': 2, 'misses': 2, 'evictions': 0,
+            'stale_hits': 0,
+        })
+
+    def test_eviction(self):
+        """
+        Test eviction of least recently used entries.
+        """
+        values = cache.Cache(max_entries=2)
+        values.set('a', 1)
+        values.set('b', 2)
+        values.get('a')
+        values.set('c', 3)
+        self.assertEqual(values.get('a'), 1)
+        self.assertIsNone(values.get('b'))
+        self.assertEqual(values.stats()['evictions'], 1)
+
+    def test_single_flight(self):
+        """
+        Test computing concurrent misses of the same key once.
+        """
+        values = cache.Cache()
+        calls = []
+        started = threading.Event()
+        finish = threading.Event()
+
+        def compute():
+            """
+            Blocks until test lets it finish.
+            """
+            calls.append(1)
+            started.set()
+            finish.wait()
+            return 'slow'
+
+        threads = [
+            threading.Thread(target=values.get_or_compute, args=('a', compute))
+            for _ in xrange(5)
+        ]
+        for thread in threads:
+            thread.start()
+        started.wait()
+        # other keys are not blocked by computation in progress
+        self.assertEqual(values.get_or_compute('b', lambda: 'fast'), 'fast')
+        finish.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(values.get('a'), 'slow')
+        self.assertEqual(values.key_locks, {})
+
+    def test_stale(self):
+        """
+        Test serving of expired value while it is refreshed in background.
+        """
+        values = cache.Cache(timeout=600, stale=3600)
+        values.set('key', 'old')
+        self.clock.now += 1200
+        finish = threading.Event()
+
+        def compute():
+            """
+            Blocks until test lets it finish.
+            """
+            finish.wait()
+            return 'new'
+
+        self.assertEqual(values.get_or_compute('key', compute), 'old')
+        self.assertEqual(values.get_or_compute('key', compute), 'old')
+        self.assertEqual(values.refreshing, set(['key']))
+        finish.set()
+        while values.refreshing:
+            time.sleep(0.001)
+        self.assertEqual(values.get_or_compute('key', compute), 'new')
+        self.assertEqual(values.stats()['stale_hits'], 2)
+
+        self.clock.now += 5000
+        self.assertEqual(values.get_or_compute('key', lambda: 'sync'), 'sync')
+
+    def test_max_bytes(self):
+        """
+        Test keeping size of cached values within budget.
+        """
+        values = cache.Cache(max_bytes=10)
+        values.set('a', 'xxxx')
+        values.set('b', 'xxxx')
+        values.set('a', 'xxxxx')
+        self.assertEqual(values.stats()['bytes'], 9)
+        values.set('c', 'xxxx')
+        self.assertIsNone(values.get('b'))
+        self.assertEqual(values.get('a'), 'xxxxx')
+        self.assertEqual(values.stats()['bytes'], 9)
+        values.set('d', 'x' * 11)
+        self.assertEqual(values.stats()['entries'], 0)
+        self.assertEqual(values.stats()['bytes'], 0)
+
+    def test_decorator(self):
+        """
+        Test caching of function output by arguments.
+        """
+        calls = []
+
+        @utils.cache(timeout=10)
+        def double(value):
+            """
+            Doubles value.
+            """
+            calls.append(value)
+            return value * 2
+
+        self.assertEqual(double(2), 4)
+        self.assertEqual(double(value=2), 4)
+        self.assertEqual(double(2), 4)
+        self.assertEqual(calls, [2, 2])
+        self.assertEqual(double.cache.stats()['hits'], 1)
+
+    def test_stamp(self):
+        """
+        Test expiring of values computed from other state of data.
+        """
+        values = cache.Cache(timeout=600, stale=3600)
+        values.set('key', 'old', stamp=1)
+        self.assertEqual(values.get('key', stamp=1), 'old')
+        self.assertIsNone(values.get('key', stamp=2))
+
+        self.assertEqual(
+            values.get_or_compute('key', lambda: 'new', stamp=2), 'old'
+        )
+        while values.refreshing:
+            time.sleep(0.001)
+        self.assertEqual(values.get('key', stamp=2), 'new')
+
+        self.clock.now += 5000
+        self.assertEqual(
+            values.get_or_compute('key', lambda: 'sync', stamp=3), 'sync'
+        )
+
+    def test_decorator_key_stamp(self):
+        """
+        Test caching by key and stamp functions of the decorator.
+        """
+        state = {'key': 'a', 'stamp': 1}
+        calls = []
+
+        @utils.cache(
+            timeout=600,
+            key=lambda: state['key'],
+            stamp=lambda: state['stamp'],
+        )
+        def load():
+            """
+            Returns key and stamp it was computed with.
+            """
+            calls.append(1)
+            return state['key'], state['stamp']
+
+        self.assertEqual(load(), ('a', 1))
+        self.assertEqual(load(), ('a', 1))
+        state['key'] = 'b'
+        self.assertEqual(load(), ('b', 1))
+        state['stamp'] = 2
+        self.assertEqual(load(), ('b', 2))
+        self.assertEqual(len(calls), 3)
+
+        load.refresh()
+        self.assertEqual(len(calls), 3)
+        state['stamp'] = 3
+        load.refresh()
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(
+            load.cache.get(((), (), 'b'), stamp=3), ('b', 3)
+        )
+
+    def test_background_disabled(self):
+        """
+        Test serving expired values without refreshing them in background.
+        """
+        values = cache.Cache(timeout=600, stale=float('inf'), background=False)
+        values.set('key', 'old', stamp=1)
+        self.clock.now += 5000
+        self.assertEqual(
+            values.get_or_compute('key', lambda: 'sync', stamp=2), 'old'
+        )
+        self.assertEqual(values.refreshing, set())
+
+        values.refresh_expired('key', lambda: 'new', stamp=2)
+        self.assertEqual(values.get('key', stamp=2), 'new')
+        values.refresh_expired('key', lambda: 'newer', stamp=2)
+        self.assertEqual(values.get('key', stamp=2), 'new')
+
+
+class PresenceAnalyzerMiddlewareTestCase(unittest.TestCase):
+    """
+    Response compression tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.middleware = middleware.GzipMiddleware(
+            main.app.wsgi_app, min_size=100
+        )
+        self.client = werkzeug.test.Client(
+            self.middleware, werkzeug.wrappers.BaseResponse
+        )
+
+    def test_gzip(self):
+        """
+        Test compressing API response and its conditional requests.
+        """
+        plain = self.client.get('/api/v1/presence_weekday/10')
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={'Accept-Encoding': 'gzip, deflate'},
+        )
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(
+            zlib.decompress(resp.data, 16 + zlib.MAX_WBITS), plain.data
+        )
+        self.assertEqual(
+            resp.headers['ETag'], plain.headers['ETag'][:-1] + '-gzip"'
+        )
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={
+                'Accept-Encoding': 'gzip',
+                'If-None-Match': resp.headers['ETag'],
+            },
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertTrue(resp.headers['ETag'].endswith('-gzip"'))
+
+    def test_gzip_bulk(self):
+        """
+        Test compressing buffered bulk API response.
+        """
+        plain = self.client.get('/api/v1/presence_weekday')
+        resp = self.client.get(
+            '/api/v1/presence_weekday', headers={'Accept-Encoding': 'gzip'}
+        )
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            zlib.decompress(resp.data, 16 + zlib.MAX_WBITS), plain.data
+        )
+
+    def test_min_size(self):
+        """
+        Test sending small responses uncompressed.
+        """
+        self.middleware.min_size = 100000
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={'Accept-Encoding': 'gzip'},
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        json.loads(resp.data)
+
+    def test_static_cache(self):
+        """
+        Test compressing static file once.
+        """
+        for _ in xrange(2):
+            resp = self.client.get(
+                '/static/js/jquery.min.js',
+                headers={'Accept-Encoding': 'deflate;q=0.5, gzip;q=0'},
+            )
+            self.assertEqual(resp.headers['Content-Encoding'], 'deflate')
+            self.assertIn('jQuery', zlib.decompress(resp.data))
+            resp.close()
+        self.assertEqual(self.middleware.cache.stats()['misses'], 1)
+        self.assertEqual(self.middleware.cache.stats()['hits'], 1)
+
 
 class PresenceAnalyzerMenuTestCase(unittest.TestCase):
     """
@@ -213,7 +2259,26 @@ def suite():
     """
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerModelsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerFetcherTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerAggregatesTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerVectorizedTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerLoaderTestCase))
+    base_suite.addTest(
+        unittest.makeSuite(PresenceAnalyzerParallelLoaderTestCase)
+    )
+    base_suite.addTest(
+        unittest.makeSuite(PresenceAnalyzerShardedLoaderTestCase)
+    )
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerSnapshotTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerSharedTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerExportTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerServerTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerMetricsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerCacheTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerMiddlewareTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerMenuTestCase))
     return base_suite
 
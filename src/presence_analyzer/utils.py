@@ -3,14 +3,19 @@
 Helper functions used in views.
 """
 
-import csv
+import hashlib
 from json import dumps
-from functools import wraps
-from datetime import datetime
-from threading import Lock
+from functools import partial, wraps
+from itertools import chain
+from timeit import default_timer
 
-from flask import Response
+from threading import Lock, Thread
 
+from flask import Response, request, url_for
+
+from presence_analyzer import metrics
+from presence_analyzer.cache import Cache
+from presence_analyzer.loader import loader_for, source_stamp
 from presence_analyzer.main import app
 from presence_analyzer.models import User
 
@@ -18,95 +23,354 @@ import logging
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
-def cache(timeout=600):
+def cache(timeout=600, max_entries=128, stale=0, key=None, stamp=None):
     """
     Decorator for caching function output
-    """
-    cache = dict()
-    lock = Lock()
 
+    Output expired less than stale seconds ago is still returned while it is
+    recomputed in background. Duration of calls and cache statistics are
+    exposed as metrics under function name.
+
+    Key and stamp are functions called with arguments of decorated function.
+    Result of key is a part of cache key, so output is cached separately
+    for each of its values. Result of stamp identifies state of data the
+    output depends on, like modification time of a file, output is
+    computed again as soon as it changes.
+
+    Decorated function has refresh function, which computes its cached
+    output again when it expired, for use outside of requests.
+    """
     def decorator(function):
         """
         Function that is used for parametrized decorator
         """
+        def lookup(args, kwargs):
+            """
+            Returns cache key and stamp of output for given arguments.
+            """
+            return (
+                (
+                    args,
+                    tuple(sorted(kwargs.items())),
+                    key(*args, **kwargs) if key is not None else None,
+                ),
+                stamp(*args, **kwargs) if stamp is not None else None,
+            )
+
         @wraps(function)
         def wrapper(*args, **kwargs):
             """
             This docstring will be overridden by @wraps decorator.
             """
-            key = '{}{}{}'.format(function, args, kwargs)
+            start = default_timer()
+            cache_key, cache_stamp = lookup(args, kwargs)
+            try:
+                return wrapper.cache.get_or_compute(
+                    cache_key, lambda: function(*args, **kwargs), cache_stamp
+                )
+            finally:
+                metrics.CALL_DURATION.observe(
+                    default_timer() - start, function.__name__
+                )
 
-            if (
-                    key in cache and
-                    timeout > (datetime.now() - cache[key]['created']).seconds
-            ):
-                return cache[key]['data']
+        def refresh(*args, **kwargs):
+            """
+            Computes output for given arguments again, unless it is fresh.
+            """
+            cache_key, cache_stamp = lookup(args, kwargs)
+            wrapper.cache.refresh_expired(
+                cache_key, lambda: function(*args, **kwargs), cache_stamp
+            )
 
-            with lock:
-                result = function(*args, **kwargs)
-                cache[key] = {
-                    'data': result,
-                    'created': datetime.now(),
-                }
-            return result
+        wrapper.refresh = refresh
+        wrapper.cache = Cache(
+            timeout=timeout,
+            max_entries=max_entries,
+            stale=stale,
+        )
+        metrics.CACHES[function.__name__] = wrapper.cache
         return wrapper
     return decorator
 
 
-def jsonify(function):
+def jsonify(function=None, version=None):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Response has a strong ETag derived from version of data it depends on
+    and request arguments. Version is a function, data_version of presence
+    data by default, views depending on other data declare theirs with
+    @jsonify(version=...). Requests with matching If-None-Match header are
+    answered with 304 Not Modified without calling the wrapped function.
+    Serialized responses are cached by their ETags. Time of calling the
+    function and of encoding its result is exposed as metrics.
     """
+    if function is None:
+        return partial(jsonify, version=version)
+
     @wraps(function)
     def inner(*args, **kwargs):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
-        )
+        etag = api_etag(version)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            endpoint = request.endpoint
+
+            def serialize():
+                """
+                Calls wrapped function and encodes its result.
+                """
+                start = default_timer()
+                result = function(*args, **kwargs)
+                encoding = default_timer()
+                data = dumps(result)
+                metrics.STAGE_DURATION.observe(
+                    encoding - start, endpoint, 'view'
+                )
+                metrics.STAGE_DURATION.observe(
+                    default_timer() - encoding, endpoint, 'encode'
+                )
+                return data
+
+            response = Response(
+                RESPONSES.get_or_compute(etag, serialize),
+                mimetype='application/json'
+            )
+        return api_headers(response, etag)
     return inner
 
 
-@cache()
+def stream_json(items, buffer_size=0):
+    """
+    Creates a response streaming JSON object of (key, value) items.
+
+    Items are serialized one by one as they are consumed, so the whole
+    document is never kept in memory, unless it is smaller than
+    buffer_size, see stream.
+    """
+    def generate():
+        """
+        Yields JSON object in chunks, one item per chunk.
+        """
+        separator = '{'
+        for key, value in items:
+            yield '{0}{1}: {2}'.format(
+                separator, dumps(str(key)), dumps(value)
+            )
+            separator = ', '
+        yield '{}' if separator == '{' else '}'
+
+    return stream(generate(), 'application/json', buffer_size)
+
+
+def stream(chunks, mimetype, buffer_size=0):
+    """
+    Creates an API response streaming given chunks.
+
+    Chunks must not depend on request context, they are consumed after
+    the view returns. ETag and 304 handling is the same as in jsonify,
+    with presence data version.
+
+    Documents smaller than buffer_size bytes are buffered and sent as
+    complete responses instead. Like those of jsonify, they are cached by
+    their ETags and have Content-Length, so they can be compressed.
+    """
+    etag = api_etag()
+    if etag in request.if_none_match:
+        return api_headers(Response(status=304), etag)
+
+    if buffer_size:
+        data = RESPONSES.get(etag)
+        if data is None:
+            chunks = iter(chunks)
+            buffered = []
+            size = 0
+            for chunk in chunks:
+                buffered.append(chunk)
+                size += len(chunk)
+                if size >= buffer_size:
+                    # too large to buffer, the rest is streamed
+                    return api_headers(
+                        Response(chain(buffered, chunks), mimetype=mimetype),
+                        etag,
+                    )
+            data = ''.join(buffered)
+            RESPONSES.set(etag, data)
+        return api_headers(Response(data, mimetype=mimetype), etag)
+
+    return api_headers(Response(chunks, mimetype=mimetype), etag)
+
+
+def api_etag(version=None):
+    """
+    Returns ETag of API response to current request.
+
+    Version is a function returning version of data the response depends
+    on, data_version by default.
+    """
+    return hashlib.sha1('{0}|{1}|{2}'.format(
+        (version or data_version)(), request.path, request.query_string,
+    )).hexdigest()
+
+
+def api_headers(response, etag):
+    """
+    Sets ETag and caching headers of API response.
+    """
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = app.config.get('API_CACHE_MAX_AGE', 0)
+    return response
+
+
+RESPONSES = Cache(
+    timeout=float('inf'),
+    max_entries=100000,
+    max_bytes=64 * 1024 * 1024,
+)
+"""Serialized API responses by ETag"""
+
+metrics.CACHES['responses'] = RESPONSES
+
+WARM_UP = {'version': None}
+"""Dataset version for which response cache was warmed up"""
+
+WARM_UP_LOCK = Lock()
+
+
+def data_version():
+    """
+    Returns version of presence data, it changes with every reload.
+    """
+    return get_data().version
+
+
+def users_version():
+    """
+    Returns version of users XML file, it changes when file is rewritten.
+    """
+    return '{0}'.format(User.stamp())
+
+
+def dataset_version():
+    """
+    Returns version of presence data and users XML file together.
+    """
+    return '{0}-{1}'.format(data_version(), users_version())
+
+
+def data_source():
+    """
+    Returns path of presence data source from configuration.
+    """
+    return app.config['DATA_CSV']
+
+
+STAMPS = Cache(timeout=1, max_entries=16)
+"""States of presence data sources by path, checked once per second"""
+
+
+def data_stamp():
+    """
+    Returns state of presence data source, see source_stamp.
+
+    Files are checked at most once per second, rather than on every call
+    of get_data, so changed files are reloaded within a second.
+    """
+    path = data_source()
+    return STAMPS.get_or_compute(path, lambda: source_stamp(path))
+
+
+@cache(max_entries=1, key=data_source, stamp=data_stamp)
 def get_data():
     """
-    Extracts presence data from CSV file and groups it by user_id.
+    Extracts presence data from CSV file into columnar PresenceStore.
+
+    DATA_CSV may also be a directory or glob pattern of CSV files. Files
+    and chunks of large files are parsed by DATA_PROCESSES worker
+    processes, one for every CPU by default. Cached data is reloaded as
+    soon as DATA_CSV setting or its files change. Only data of the current
+    DATA_CSV is cached, so data of previous one can be freed.
 
-    It creates structure like this:
+    Stored entries can be looked up by user_id like in a dict:
     data = {
         'user_id': {
             datetime.date(2013, 10, 1): {
                 'start': datetime.time(9, 0, 0),
                 'end': datetime.time(17, 30, 0),
             },
-            datetime.date(2013, 10, 2): {
-                'start': datetime.time(8, 30, 0),
-                'end': datetime.time(16, 45, 0),
-            },
         }
     }
+    but hot paths should use PresenceStore.entries instead.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    data = loader_for(data_source()).load(
+        snapshot=app.config.get('DATA_SNAPSHOT', False),
+        shared=app.config.get('DATA_SHARED', False),
+        processes=app.config.get('DATA_PROCESSES', 0),
+    )
+    if app.config.get('API_WARM_UP', False):
+        start_warm_up(data.version)
+    return data
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+@cache(max_entries=4)
+def team_rollups(version):  # pylint: disable=unused-argument
+    """
+    Sums weekday aggregates of members of every team from users XML file.
 
-    return data
+    Returns dict of team: (member ids, weekday aggregates). Dataset version
+    is only the cache key, so rollups are computed once per reload of data
+    or users XML file rather than on every request.
+    """
+    data = get_data()
+    teams = {}
+    for user in User.get_data():
+        if user.get('team'):
+            teams.setdefault(user['team'], []).append(int(user['user_id']))
+    return dict(
+        (team, (members, data.rollup(members)))
+        for team, members in teams.iteritems()
+    )
+
+
+def start_warm_up(version):
+    """
+    Starts filling response cache for given dataset version in background.
+    """
+    with WARM_UP_LOCK:
+        if WARM_UP['version'] == version:
+            return
+        WARM_UP['version'] = version
+
+    thread = Thread(target=warm_up, args=(version, ))
+    thread.daemon = True
+    thread.start()
+
+
+def warm_up(version):
+    """
+    Requests API views of every user, so their responses get cached.
+
+    Views taking user_id as the only argument are requested. Warm up stops
+    when data is reloaded again.
+    """
+    client = app.test_client()
+    with app.test_request_context():
+        urls = [
+            url_for(rule.endpoint, user_id=user_id)
+            for rule in app.url_map.iter_rules()
+            if rule.arguments == set(['user_id'])
+            for user_id in get_data()
+        ]
+
+    for url in urls:
+        if get_data().version != version:
+            break
+        client.get(url)
+    log.debug('Warmed up %d responses', len(urls))
 
 
 def group_by_weekday(items):
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Weekday statistics of all users computed at once.
+
+NumPy is used when it is installed, otherwise statistics are computed
+from weekday aggregates of the store in pure Python.
+"""
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # pylint: disable=invalid-name
+
+
+def python_weekday_stats(store):
+    """
+    Computes weekday statistics of every user in pure Python.
+
+    Returns dict of user_id: list of (count, total interval, mean interval,
+    mean start, mean end) tuples, one for every day in week.
+    """
+    result = {}
+    for user_id, weekdays in store.weekdays.iteritems():
+        result[user_id] = [
+            (
+                count,
+                total,
+                float(total) / count if count else 0,
+                float(starts) / count if count else 0,
+                float(ends) / count if count else 0,
+            )
+            for count, total, starts, ends in weekdays
+        ]
+    return result
+
+
+def as_numpy(column):
+    """
+    Returns NumPy view of store column without copying it.
+    """
+    if isinstance(column, numpy.ndarray):
+        return column
+    return numpy.frombuffer(column, dtype='i%d' % column.itemsize)
+
+
+def numpy_weekday_stats(store):
+    """
+    Computes weekday statistics of every user with grouped NumPy reductions.
+
+    Returns the same structure as python_weekday_stats.
+    """
+    if not len(store):
+        return {}
+
+    user_ids = as_numpy(store.user_ids)
+    days = as_numpy(store.days)
+    starts = as_numpy(store.starts).astype(numpy.int64)
+    ends = as_numpy(store.ends).astype(numpy.int64)
+
+    users, positions = numpy.unique(user_ids, return_inverse=True)
+    groups = positions * 7 + (days + 6) % 7
+    size = len(users) * 7
+
+    counts = numpy.bincount(groups, minlength=size)
+    sums = [
+        numpy.bincount(groups, weights=weights, minlength=size)
+        for weights in (ends - starts, starts, ends)
+    ]
+    divisors = numpy.maximum(counts, 1)
+    means = [column / divisors for column in sums]
+
+    table = numpy.column_stack([counts, sums[0]] + means).reshape(-1, 7, 5)
+    return dict(
+        (
+            int(user_id),
+            [
+                (int(count), int(total), interval, start, end)
+                for count, total, interval, start, end in weekdays.tolist()
+            ],
+        )
+        for user_id, weekdays in zip(users, table)
+    )
+
+
+def weekday_stats(store):
+    """
+    Computes weekday statistics of every user with the fastest engine.
+    """
+    if numpy is None:
+        return python_weekday_stats(store)
+    return numpy_weekday_stats(store)
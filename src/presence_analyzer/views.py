@@ -3,24 +3,78 @@
 Defines views.
 """
 import calendar
-from collections import defaultdict
+from collections import OrderedDict
+from timeit import default_timer
 
-from flask import abort, redirect, render_template, url_for
+from flask import (
+    Response,
+    abort,
+    g,
+    redirect,
+    render_template,
+    request,
+    url_for,
+)
 
+from presence_analyzer import metrics
+from presence_analyzer.export import EXPORTS, FORMATS
+from presence_analyzer.loader import (
+    LOADERS,
+    REJECTIONS,
+    loader_for,
+    parse_date,
+)
 from presence_analyzer.main import app
 from presence_analyzer.models import User
 from presence_analyzer.utils import (
+    data_source,
+    dataset_version,
     get_data,
-    group_by_weekday,
     jsonify,
-    mean,
-    seconds_since_midnight as ssm
+    stream,
+    stream_json,
+    team_rollups,
+    users_version,
 )
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
+@app.before_request
+def start_timer():
+    """
+    Notes when handling of request started.
+    """
+    g.request_start = default_timer()
+
+
+@app.after_request
+def observe_request(response):
+    """
+    Records duration of handling request.
+
+    Streamed responses are observed before their body is generated.
+    """
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        metrics.REQUEST_DURATION.observe(
+            default_timer() - start, request.endpoint, response.status_code
+        )
+    return response
+
+
+@app.route('/metrics')
+def metrics_view():
+    """
+    Exposes metrics in Prometheus text format.
+    """
+    return Response(
+        metrics.render(LOADERS.values()),
+        mimetype='text/plain; version=0.0.4',
+    )
+
+
 @app.route('/')
 def mainpage():
     """
@@ -54,7 +108,7 @@ def presence_start_end():
 
 
 @app.route('/api/v1/users', methods=['GET'])
-@jsonify
+@jsonify(version=users_version)
 def users_view():
     """
     Users listing for dropdown.
@@ -62,24 +116,140 @@ def users_view():
     return User.get_data()
 
 
-@app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
-@jsonify
-def mean_time_weekday_view(user_id):
+def mean_times(weekdays):
     """
-    Returns mean presence time of given user grouped by weekday.
+    Returns mean presence time by weekday from user's weekday aggregates.
+    """
+    return [
+        (calendar.day_abbr[weekday], float(total) / count if count else 0)
+        for weekday, (count, total, _, _) in enumerate(weekdays)
+    ]
+
+
+def presence_totals(weekdays):
+    """
+    Returns total presence time by weekday from user's weekday aggregates.
+    """
+    result = [
+        (calendar.day_abbr[weekday], total)
+        for weekday, (_, total, _, _) in enumerate(weekdays)
+    ]
+
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def start_end_times(weekdays):
+    """
+    Returns average start/end time by weekday from user's weekday aggregates.
+    """
+    return [
+        [calendar.day_name[weekday][:3], starts // count, ends // count]
+        for weekday, (count, _, starts, ends) in enumerate(weekdays[:5])
+        if count > 0
+    ]
+
+
+def date_range():
+    """
+    Returns day ordinals of from and to args, None for missing ones.
+    """
+    bounds = []
+    for name in ('from', 'to'):
+        value = request.args.get(name)
+        try:
+            bounds.append(None if value is None else parse_date(value))
+        except ValueError:
+            abort(400)
+
+    if None not in bounds and bounds[0] > bounds[1]:
+        abort(400)
+    return bounds
+
+
+def user_weekdays(user_id):
+    """
+    Returns weekday aggregates of given user, aborts if there are none.
+
+    Aggregates are limited to date range given in from and to args.
     """
+    first, last = date_range()
     data = get_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
+    return data.range_weekdays(user_id, first, last)
+
+
+def requested_users(data):
+    """
+    Returns ids of users requested in user_id args, all users by default.
+
+    Repeated ids are returned once, in order of their first occurrence.
+    """
+    try:
+        user_ids = OrderedDict.fromkeys(
+            int(value) for value in request.args.getlist('user_id')
+        )
+    except ValueError:
+        abort(400)
+    return list(user_ids) or sorted(data)
+
+
+def users_weekdays():
+    """
+    Returns (user_id, weekday aggregates) of users requested in user_id args.
+
+    All users are returned when no user_id is given, aggregates of unknown
+    users are None. Aggregates are limited to date range given in from and
+    to args. Arguments are validated right away, but aggregates are only
+    computed as items are consumed, so responses answered with 304 Not
+    Modified compute none.
+    """
+    first, last = date_range()
+    data = get_data()
+    return (
+        (
+            user_id,
+            data.range_weekdays(user_id, first, last)
+            if user_id in data else None,
+        )
+        for user_id in requested_users(data)
+    )
+
+
+def users_results(function):
+    """
+    Streams results of function applied to requested users' aggregates.
+
+    Documents smaller than API_BULK_BUFFER_BYTES are sent as complete,
+    cached and compressible, responses.
+    """
+    return stream_json(
+        (
+            (user_id, None if weekdays is None else function(weekdays))
+            for user_id, weekdays in users_weekdays()
+        ),
+        app.config.get('API_BULK_BUFFER_BYTES', 1024 * 1024),
+    )
+
+
+@app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
+@jsonify
+def mean_time_weekday_view(user_id):
+    """
+    Returns mean presence time of given user grouped by weekday.
+    """
+    return mean_times(user_weekdays(user_id))
 
-    return result
+
+@app.route('/api/v1/mean_time_weekday', methods=['GET'])
+def mean_time_weekday_bulk_view():
+    """
+    Returns mean presence time of many users grouped by weekday.
+    """
+    return users_results(mean_times)
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
@@ -88,19 +258,15 @@ def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
-        abort(404)
+    return presence_totals(user_weekdays(user_id))
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
 
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+@app.route('/api/v1/presence_weekday', methods=['GET'])
+def presence_weekday_bulk_view():
+    """
+    Returns total presence time of many users grouped by weekday.
+    """
+    return users_results(presence_totals)
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
@@ -109,23 +275,112 @@ def presence_start_end_data(user_id):
     """
     Returns average start/end time of given user grouped by weekday.
     """
+    return start_end_times(user_weekdays(user_id))
+
+
+@app.route('/api/v1/presence_start_end', methods=['GET'])
+def presence_start_end_bulk_view():
+    """
+    Returns average start/end time of many users grouped by weekday.
+    """
+    return users_results(start_end_times)
+
+
+REPORTS = {
+    'mean_time_weekday': mean_times,
+    'presence_weekday': presence_totals,
+    'presence_start_end': start_end_times,
+}
+"""Result builders of group views by report name"""
+
+
+@app.route('/api/v1/company/<report>', methods=['GET'])
+@jsonify
+def company_view(report):
+    """
+    Returns report of the whole company.
+    """
+    if report not in REPORTS:
+        abort(404)
+
+    first, last = date_range()
     data = get_data()
-    if user_id not in data:
-        log.debug('User %s not found!', user_id)
+    if first is None and last is None:
+        return REPORTS[report](data.totals)
+    return REPORTS[report](data.rollup(data.index, first, last))
+
+
+@app.route('/api/v1/teams', methods=['GET'])
+@jsonify(version=dataset_version)
+def teams_view():
+    """
+    Returns ids of members of every team.
+    """
+    return dict(
+        (team, members)
+        for team, (members, _) in team_rollups(dataset_version()).iteritems()
+    )
+
+
+@app.route('/api/v1/teams/<team>/<report>', methods=['GET'])
+@jsonify(version=dataset_version)
+def team_view(team, report):
+    """
+    Returns report of given team.
+    """
+    rollups = team_rollups(dataset_version())
+    if report not in REPORTS or team not in rollups:
         abort(404)
 
-    sums = defaultdict(lambda: defaultdict(int))
-    for date in data[user_id]:
-        sums[date.weekday()]['items'] += 1
-        sums[date.weekday()]['start'] += ssm(data[user_id][date]['start'])
-        sums[date.weekday()]['end'] += ssm(data[user_id][date]['end'])
+    first, last = date_range()
+    members, weekdays = rollups[team]
+    if first is not None or last is not None:
+        weekdays = get_data().rollup(members, first, last)
+    return REPORTS[report](weekdays)
 
-    return [
-        [
-            calendar.day_name[i][:3],
-            sums[i]['start'] / sums[i]['items'],
-            sums[i]['end'] / sums[i]['items']
-        ]
-        for i in xrange(5)
-        if sums[i]['items'] > 0
-    ]
+
+@app.route(
+    '/api/v1/export/<any(presence, weekdays):name>.<any(csv, ndjson):fmt>',
+    methods=['GET'],
+)
+def export_view(name, fmt):
+    """
+    Streams presence entries or weekday aggregates as CSV or NDJSON.
+
+    Export is limited to users given in user_id args and to date range
+    given in from and to args.
+    """
+    first, last = date_range()
+    data = get_data()
+    user_ids = requested_users(data)
+    fields, records = EXPORTS[name]
+    chunks, mimetype = FORMATS[fmt]
+    return stream(
+        chunks(fields, records(data, user_ids, first, last)), mimetype
+    )
+
+
+@app.route('/api/v1/admin/quarantine', methods=['GET'])
+@jsonify
+def quarantine_view():
+    """
+    Returns lines of CSV files rejected by validation and their counts.
+
+    Counts are given for every reason, lines can be limited to one reason
+    given in reason arg.
+    """
+    get_data()
+    rejected = loader_for(data_source()).quarantine()
+    reason = request.args.get('reason')
+    return {
+        'total': len(rejected),
+        'counts': dict(
+            (name, sum(1 for record in rejected if record[2] == name))
+            for name in REJECTIONS
+        ),
+        'lines': [
+            {'path': path, 'line': number, 'reason': name, 'text': text}
+            for path, number, name, text in rejected
+            if reason is None or name == reason
+        ],
+    }